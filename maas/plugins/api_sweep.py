@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+# Copyright 2015, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Probe several local APIs at once with a single token and connection pool.
+
+Each service is given as NAME=IP[:PORT][/PATH]. Every service gets the
+<name>_api_local_status and <name>_api_local_response_time metrics of
+service_api_local_check; with --details nova, cinder, glance, heat, keystone
+and neutron also get the other metrics of the matching *_api_local_check
+plugin, under the same names::
+
+    api_sweep.py nova=172.29.236.100 neutron=172.29.236.100 \\
+        horizon=172.29.236.100:80/auth/login/
+
+The services are probed concurrently, so the sweep takes as long as the
+slowest API. The usual limit on the number of metrics per check applies to
+the sweep as a whole, which the details of all six services exceed.
+"""
+
+import argparse
+import collections
+import logging
+
+from maas_common import fan_out
+from maas_common import get_auth_ref
+from maas_common import get_project_id
+from maas_common import get_requests_session
+from maas_common import json_values
+from maas_common import metric
+from maas_common import metric_bool
+from maas_common import print_output
+from maas_common import status_ok
+from requests import adapters
+from requests import exceptions as exc
+
+SERVER_STATUSES = ['ACTIVE', 'STOPPED', 'ERROR']
+VOLUME_STATUSES = ['available', 'in-use', 'error']
+IMAGE_STATUSES = ['active', 'queued', 'killed']
+TIMEOUT = 10
+
+
+class APIDown(Exception):
+    pass
+
+
+def get(session, url, stream=False):
+    try:
+        r = session.get(url, verify=False, timeout=TIMEOUT, stream=stream)
+        r.raise_for_status()
+    except (exc.ConnectionError, exc.HTTPError, exc.Timeout) as e:
+        raise APIDown(str(e))
+    return r
+
+
+def response_time(r):
+    return ('%.3f' % (r.elapsed.total_seconds() * 1000), 'double', 'ms')
+
+
+def probe_nova(session, endpoint, tenant_id, details):
+    endpoint = '%s/v2/%s' % (endpoint, tenant_id)
+    r = get(session, '%s/os-services' % endpoint)
+    metrics = [('nova_api_local_response_time',) + response_time(r)]
+    if not details:
+        return metrics
+    servers = get(session, '%s/servers/detail?all_tenants=1' % endpoint)
+    status_count = collections.Counter(
+        s['status'] for s in servers.json()['servers'])
+    for status in SERVER_STATUSES:
+        metrics.append(('nova_instances_in_state_%s' % status,
+                        status_count[status], 'uint32', 'instances'))
+    return metrics
+
+
+def probe_cinder(session, endpoint, tenant_id, details):
+    endpoint = '%s/v1/%s' % (endpoint, tenant_id)
+    vol = get(session, '%s/volumes/detail' % endpoint)
+    metrics = [('cinder_api_local_response_time',) + response_time(vol)]
+    if not details:
+        return metrics
+    snap = get(session, '%s/snapshots/detail' % endpoint)
+    volumes = vol.json()['volumes']
+    snapshots = snap.json()['snapshots']
+    vol_status_count = collections.Counter(v['status'] for v in volumes)
+    snap_status_count = collections.Counter(s['status'] for s in snapshots)
+
+    metrics.append(('total_cinder_volumes', len(volumes), 'uint32',
+                    'volumes'))
+    for status in VOLUME_STATUSES:
+        metrics.append(('cinder_%s_volumes' % status,
+                        vol_status_count[status], 'uint32', 'volumes'))
+    metrics.append(('total_cinder_snapshots', len(snapshots), 'uint32',
+                    'snapshots'))
+    for status in VOLUME_STATUSES:
+        metrics.append(('cinder_%s_snaps' % status,
+                        snap_status_count[status], 'uint32', 'snapshots'))
+    return metrics
+
+
+def probe_glance(session, endpoint, tenant_id, details):
+    endpoint = '%s/v1' % endpoint
+    r = get(session, '%s/' % endpoint)
+    metrics = [('glance_api_local_response_time',) + response_time(r)]
+    if not details:
+        return metrics
+    images = get(session, '%s/images/detail' % endpoint, stream=True)
+    status_count = collections.Counter(
+        json_values(images, 'images.item.status'))
+    for status in IMAGE_STATUSES:
+        metrics.append(('glance_%s_images' % status,
+                        status_count[status], 'uint32', 'images'))
+    return metrics
+
+
+def probe_heat(session, endpoint, tenant_id, details):
+    r = get(session, '%s/v1/%s/build_info' % (endpoint, tenant_id))
+    return [('heat_api_local_response_time',) + response_time(r)]
+
+
+def probe_keystone(session, endpoint, tenant_id, details):
+    endpoint = '%s/v3' % endpoint
+    r = get(session, '%s/services' % endpoint)
+    metrics = [('keystone_api_local_response_time',) + response_time(r)]
+    if not details:
+        return metrics
+    projects = get(session, '%s/projects' % endpoint).json()['projects']
+    users = get(session, '%s/users?domain_id=Default' % endpoint)
+    return metrics + [
+        ('keystone_user_count', len(users.json()['users']), 'uint32',
+         'users'),
+        ('keystone_tenant_count', len(projects), 'uint32', 'tenants')]
+
+
+def probe_neutron(session, endpoint, tenant_id, details):
+    endpoint = '%s/v2.0' % endpoint
+    r = get(session, '%s/agents' % endpoint)
+    metrics = [('neutron_api_local_response_time',) + response_time(r)]
+    if not details:
+        return metrics
+    for resource, unit in (('networks', 'networks'), ('agents', 'agents'),
+                           ('routers', 'agents'), ('subnets', 'subnets')):
+        if resource == 'agents':
+            items = r.json()['agents']
+        else:
+            items = get(session, '%s/%s' % (endpoint, resource)).json()[
+                resource]
+        metrics.append(('neutron_%s' % resource, len(items), 'uint32', unit))
+    return metrics
+
+
+# {name: (default port, probe)}
+SERVICES = {'nova': (8774, probe_nova),
+            'cinder': (8776, probe_cinder),
+            'glance': (9292, probe_glance),
+            'heat': (8004, probe_heat),
+            'keystone': (35357, probe_keystone),
+            'neutron': (9696, probe_neutron)}
+
+
+def probe_service(session, endpoint, path, name):
+    r = get(session, '%s%s' % (endpoint, path))
+    return [('%s_api_local_response_time' % name,) + response_time(r)]
+
+
+def parse_service(spec):
+    """Turn NAME=IP[:PORT][/PATH] into (name, ip, port, path)."""
+    try:
+        name, address = spec.split('=', 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not NAME=IP[:PORT][/PATH]' %
+                                         spec)
+    address, _, path = address.partition('/')
+    ip, _, port = address.partition(':')
+    if not port:
+        if name not in SERVICES:
+            raise argparse.ArgumentTypeError('%s needs a port' % spec)
+        port = SERVICES[name][0]
+    return name, ip, int(port), path and '/' + path
+
+
+def sweep(service, session, tenant_id, details=False):
+    """Probe one service; return (is_up, metrics, error).
+
+    A service failing in an unexpected way is reported as down with the
+    error, rather than failing the probes of all the others.
+    """
+    name, ip, port, path = service
+    endpoint = 'http://%s:%d' % (ip, port)
+    try:
+        if name in SERVICES and not path:
+            return True, SERVICES[name][1](session, endpoint, tenant_id,
+                                           details), None
+        return True, probe_service(session, endpoint, path, name), None
+    except APIDown:
+        return False, [], None
+    except Exception as e:
+        logging.exception('Probing %s failed', name)
+        return False, [], '%s: %s' % (name, e)
+
+
+def check(args):
+    auth_ref = get_auth_ref()
+    tenant_id = get_project_id(auth_ref)
+
+    session = get_requests_session(auth_ref['auth_token'])
+    concurrency = min(args.concurrency, len(args.services))
+    adapter = adapters.HTTPAdapter(pool_connections=concurrency,
+                                   pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+
+    results = fan_out(lambda s: sweep(s, session, tenant_id, args.details),
+                      args.services, workers=concurrency)
+
+    errors = [error for _, _, error in results if error]
+    status_ok('; '.join(errors)[-250:] if errors else None)
+    for (name, _, _, _), (is_up, metrics, _) in zip(args.services, results):
+        metric_bool('%s_api_local_status' % name, is_up)
+        for metric_name, value, metric_type, unit in metrics:
+            metric(metric_name, metric_type, value, unit)
+
+
+def main(args):
+    check(args)
+
+
+if __name__ == "__main__":
+    with print_output():
+        parser = argparse.ArgumentParser(
+            description='Check several APIs concurrently')
+        parser.add_argument('services', nargs='+', type=parse_service,
+                            metavar='NAME=IP[:PORT][/PATH]',
+                            help='Service to probe. nova, cinder, glance, '
+                                 'heat, keystone and neutron need no port.')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Maximum number of services probed at once.')
+        parser.add_argument('--details', action='store_true', default=False,
+                            help='Also report the resource counts of nova, '
+                                 'cinder, glance, keystone and neutron.')
+        args = parser.parse_args()
+        main(args)
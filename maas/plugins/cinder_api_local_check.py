@@ -22,12 +22,12 @@ import ipaddr
 # consideres it third-party
 from maas_common import get_auth_ref
 from maas_common import get_keystone_client
+from maas_common import get_requests_session
 from maas_common import metric
 from maas_common import metric_bool
 from maas_common import print_output
 from maas_common import status_err
 from maas_common import status_ok
-import requests
 from requests import exceptions as exc
 
 VOLUME_STATUSES = ['available', 'in-use', 'error']
@@ -44,11 +44,7 @@ def check(auth_ref, args):
     VOLUME_ENDPOINT = ('http://{ip}:8776/v1/{tenant}'.format
                        (ip=args.ip, tenant=keystone.tenant_id))
 
-    s = requests.Session()
-
-    s.headers.update(
-        {'Content-type': 'application/json',
-         'x-auth-token': auth_token})
+    s = get_requests_session(auth_token)
 
     try:
         vol = s.get('%s/volumes/detail' % VOLUME_ENDPOINT,
@@ -19,12 +19,14 @@ import argparse
 # Technically maas_common isn't third-party but our own thing but hacking
 # consideres it third-party
 from maas_common import get_auth_ref
+from maas_common import get_cluster_snapshot
 from maas_common import get_keystone_client
+from maas_common import get_requests_session
+from maas_common import metric
 from maas_common import metric_bool
 from maas_common import print_output
 from maas_common import status_err
 from maas_common import status_ok
-import requests
 from requests import exceptions as exc
 
 # NOTE(mancdaz): until https://review.openstack.org/#/c/111051/
@@ -32,25 +34,9 @@ from requests import exceptions as exc
 # cinderclient. Only way to test local is direct http. :sadface:
 
 
-def check(auth_ref, args):
-
-    keystone = get_keystone_client(auth_ref)
-    auth_token = keystone.auth_token
-    VOLUME_ENDPOINT = (
-        'http://{hostname}:8776/v1/{tenant}'.format(hostname=args.hostname,
-                                                    tenant=keystone.tenant_id)
-    )
-
-    s = requests.Session()
-
-    s.headers.update(
-        {'Content-type': 'application/json',
-         'x-auth-token': auth_token})
-
+def get_services(session, url, stats):
     try:
-        # We cannot do /os-services?host=X as cinder returns a hostname of
-        # X@lvm for cinder-volume binary
-        r = s.get('%s/os-services' % VOLUME_ENDPOINT, verify=False, timeout=10)
+        r = session.get(url, verify=False, timeout=10)
     except (exc.ConnectionError,
             exc.HTTPError,
             exc.Timeout) as e:
@@ -59,14 +45,43 @@ def check(auth_ref, args):
     if not r.ok:
         status_err('could not get response from cinder api')
 
-    services = r.json()['services']
+    stats['bytes'] += len(r.content)
+    stats['time'] += r.elapsed.total_seconds() * 1000
+    return r.json()['services']
+
+
+def check(auth_ref, args):
+
+    keystone = get_keystone_client(auth_ref)
+    auth_token = keystone.auth_token
+    VOLUME_ENDPOINT = (
+        'http://{hostname}:8776/v1/{tenant}'.format(hostname=args.hostname,
+                                                    tenant=keystone.tenant_id)
+    )
+
+    s = get_requests_session(auth_token)
+    stats = {'bytes': 0, 'time': 0.0}
 
-    # We need to match against a host of X and X@lvm (or whatever backend)
     if args.host:
-        backend = ''.join((args.host, '@'))
-        services = [service for service in services
-                    if (service['host'].startswith(backend) or
-                        service['host'] == args.host)]
+        # cinder-volume services are named X@backend. Newer APIs match those
+        # against ?host=X as well; older ones only return exact matches, in
+        # which case the volume services are listed separately, from a
+        # snapshot shared by the checks of every host when there is one.
+        services = get_services(s, '%s/os-services?host=%s' %
+                                (VOLUME_ENDPOINT, args.host), stats)
+        if not any('@' in service['host'] for service in services):
+            url = '%s/os-services?binary=cinder-volume' % VOLUME_ENDPOINT
+            volumes = get_cluster_snapshot(
+                'cinder_volume_services', args.snapshot_ttl,
+                lambda: get_services(s, url, stats),
+                servers=args.memcached, path=args.snapshot_file)
+            if volumes is None:
+                volumes = get_services(s, url, stats)
+            backend = ''.join((args.host, '@'))
+            services.extend(service for service in volumes
+                            if service['host'].startswith(backend))
+    else:
+        services = get_services(s, '%s/os-services' % VOLUME_ENDPOINT, stats)
 
     if len(services) == 0:
         status_err('No host(s) found in the service list')
@@ -84,6 +99,11 @@ def check(auth_ref, args):
 
         metric_bool(name, service_is_up)
 
+    metric('cinder_service_check_response_bytes', 'uint64', stats['bytes'],
+           'bytes')
+    metric('cinder_service_check_response_time', 'double',
+           '%.3f' % stats['time'], 'ms')
+
 
 def main(args):
     auth_ref = get_auth_ref()
@@ -98,5 +118,24 @@ if __name__ == "__main__":
         parser.add_argument('--host',
                             type=str,
                             help='Only return metrics for the specified host')
+        parser.add_argument('--snapshot-file',
+                            type=str,
+                            help='Where the cinder-volume services are shared '
+                                 'between checks when the API cannot filter '
+                                 'them by host and no memcached servers are '
+                                 'given; only for a file the checks of '
+                                 'several hosts share',
+                            default=None)
+        parser.add_argument('--memcached',
+                            type=lambda servers: [
+                                s for s in servers.split(',') if s],
+                            help='Comma separated memcached host:port list '
+                                 'sharing the cinder-volume services',
+                            default=None)
+        parser.add_argument('--snapshot-ttl',
+                            type=int,
+                            help='Seconds for which the shared cinder-volume '
+                                 'services are reused',
+                            default=60)
         args = parser.parse_args()
         main(args)
@@ -18,6 +18,7 @@ import json
 import optparse
 import os
 import re
+import time
 
 from maas_common import metric
 from maas_common import print_output
@@ -43,14 +44,59 @@ def get_elasticsearch_bind_host():
 
 ES_PORT = '9200'
 ELASTICSEARCH = None
-
-
-def json_querystring(query_string, sort=None):
-    """Generate the JSON data for a query_string query."""
-    query_dict = {'query': {'query_string': query_string}}
-    if sort:
-        query_dict['sort'] = sort
-    return json.dumps(query_dict)
+# {metric: query_string query} of the log levels counted, over the latest
+# index and, with --window, over the last minutes
+LEVELS = {'NUMBER_OF_LOG_ERRORS': 'ERROR',
+          'NUMBER_OF_LOG_WARNINGS': 'WARN*'}
+WINDOW_LEVELS = {'log_errors': 'ERROR',
+                 'log_warnings': 'WARN*'}
+LEVEL_FIELDS = ['os_level', 'message']
+# tags which logstash and beaver give to the logs of every service; they
+# match whole values, i.e. the not analyzed .raw sub-field of the mapping
+COMMON_TAGS = ('openstack|oslofmt|beaver|apimetrics|apache-.*|logstash-.*|'
+               '_grokparsefailure')
+
+
+def level_filters(levels):
+    """Generate a filters aggregation with a bucket for each log level.
+
+    ``levels`` maps the bucket names to query_string queries, which are
+    matched against LEVEL_FIELDS.
+    """
+    return {'filters': {'filters': dict(
+        (name, {'query': {'query_string': {'query': level,
+                                           'fields': LEVEL_FIELDS}}})
+        for name, level in levels.items())}}
+
+
+def json_count_filters(levels):
+    """Generate the JSON data counting the logs of each of ``levels``.
+
+    No hits are returned, only the aggregation.
+    """
+    return json.dumps({'size': 0, 'aggs': {'levels': level_filters(levels)}})
+
+
+def json_window(levels, minutes, field, top):
+    """Generate the JSON data breaking down the logs of the last minutes.
+
+    The logs of each of ``levels`` are counted per minute and for each of
+    the ``top`` values of ``field`` they are the most numerous for. String
+    fields are analyzed, so ``field`` should be a .raw sub-field holding the
+    whole values rather than their words.
+    """
+    aggs = level_filters(levels)
+    aggs['aggs'] = {
+        'top': {'terms': {'field': field, 'size': top,
+                          'exclude': COMMON_TAGS}},
+        'per_minute': {'date_histogram': {'field': '@timestamp',
+                                          'interval': '1m',
+                                          'min_doc_count': 0}}}
+    return json.dumps({
+        'size': 0,
+        'query': {'filtered': {'filter': {'range': {
+            '@timestamp': {'gte': 'now-%dm' % minutes}}}}},
+        'aggs': {'levels': aggs}})
 
 
 def json_filter(filtered_query):
@@ -59,12 +105,9 @@ def json_filter(filtered_query):
 
 
 def find_indices():
-    """Find indices created by logstash."""
-    url = ELASTICSEARCH + '/_search'
-    query = json_querystring({'query': '_index like logstash%'},
-                             [{'_index': {'order': 'desc'}}])
-    json = get_json(url, query)
-    return sorted(res['_index'] for res in json['hits']['hits'])
+    """Find indices created by logstash, by name only."""
+    url = ELASTICSEARCH + '/_cat/indices/logstash-*?h=index'
+    return sorted(get(url).text.split())
 
 
 def most_recent_index():
@@ -77,30 +120,72 @@ def most_recent_index():
     return indices[-1]
 
 
+def window_indices(minutes):
+    """Name the daily logstash indices holding the logs of the last minutes.
+
+    logstash names them after the UTC day of the logs.
+    """
+    now = time.time()
+    return ['logstash-%s' % time.strftime('%Y.%m.%d', time.gmtime(day * 86400))
+            for day in range(int(now - minutes * 60) // 86400,
+                             int(now) // 86400 + 1)]
+
+
 def search_url_for(index):
     """Generate the search URL for an index."""
     return ELASTICSEARCH + '/' + index + '/_search'
 
 
-def get_json(url, data):
+def get(url, data=None):
     """Wrap calls to requests to handle exceptions."""
     exceptions = (requests.exceptions.HTTPError,
                   requests.exceptions.ConnectionError)
     try:
         r = requests.get(url, data=data)
+        r.raise_for_status()
     except exceptions as e:
         status_err(str(e))
 
-    return r.json()
+    return r
 
 
-def get_number_of(loglevel, index):
-    """Retrieve the number of logs with level ``loglevel``."""
-    url = search_url_for(index)
-    data = json_querystring({'query': loglevel,
-                             'fields': ['os_level', 'message']})
-    json = get_json(url, data)
-    return json['hits']['total']
+def get_json(url, data):
+    return get(url, data).json()
+
+
+def count_levels(index):
+    """Retrieve the number of logs of each of LEVELS in a single search."""
+    json = get_json(search_url_for(index), json_count_filters(LEVELS))
+    buckets = json['aggregations']['levels']['buckets']
+    return dict((name, bucket['doc_count'])
+                for name, bucket in buckets.items())
+
+
+def check_window(minutes, field, top):
+    """Report the rates of the logs of each level over the last minutes.
+
+    The indices of the window, which spans midnight at times, are searched
+    at once; those not created yet are ignored.
+    """
+    url = (search_url_for(','.join(window_indices(minutes))) +
+           '?ignore_unavailable=true')
+    json = get_json(url, json_window(WINDOW_LEVELS, minutes, field, top))
+    buckets = json['aggregations']['levels']['buckets']
+
+    status_ok()
+    for name in sorted(buckets):
+        bucket = buckets[name]
+        per_minute = [b['doc_count']
+                      for b in bucket['per_minute']['buckets']]
+        metric('%s_per_minute' % name, 'double',
+               '%.3f' % (bucket['doc_count'] / float(minutes)), 'logs')
+        metric('%s_per_minute_max' % name, 'uint32', max(per_minute or [0]),
+               'logs')
+        for service in bucket['top']['buckets']:
+            key = re.sub(r'\W+', '_', service['key'])
+            metric('%s_per_minute_%s' % (name, key), 'double',
+                   '%.3f' % (service['doc_count'] / float(minutes)), 'logs',
+                   family='%s_per_minute' % name)
 
 
 def parse_args():
@@ -112,6 +197,19 @@ def parse_args():
     parser.add_option('-P', '--port', action='store', dest='port',
                       default=ES_PORT,
                       help='Port to use to connect to Elasticsearch')
+    parser.add_option('-w', '--window', action='store', dest='window',
+                      type='int', default=None,
+                      help=('Report the rates of the logs of the last '
+                            'WINDOW minutes instead of the counts of the '
+                            'latest index'))
+    parser.add_option('--field', action='store', dest='field',
+                      default='tags.raw',
+                      help=('Field telling the services apart in --window '
+                            'mode, e.g. tags.raw or program.raw'))
+    parser.add_option('--top', action='store', dest='top', type='int',
+                      default=5,
+                      help=('Number of the services with the most logs of '
+                            'each level reported in --window mode'))
     return parser.parse_args()
 
 
@@ -126,13 +224,16 @@ def main():
     options, _ = parse_args()
     configure(options)
 
+    if options.window:
+        check_window(options.window, options.field, options.top)
+        return
+
     latest = most_recent_index()
-    num_errors = get_number_of('ERROR', latest)
-    num_warnings = get_number_of('WARN*', latest)
+    counts = count_levels(latest)
 
     status_ok()
-    metric('NUMBER_OF_LOG_ERRORS', 'uint32', num_errors)
-    metric('NUMBER_OF_LOG_WARNINGS', 'uint32', num_warnings)
+    for name in sorted(counts):
+        metric(name, 'uint32', counts[name])
 
 
 if __name__ == '__main__':
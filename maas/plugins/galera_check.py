@@ -15,14 +15,58 @@
 # limitations under the License.
 
 import optparse
+import os
 import shlex
 import subprocess
 
+from maas_common import counter_rates
+from maas_common import fan_out
+from maas_common import history_path
+from maas_common import MAX_METRICS
 from maas_common import metric
+from maas_common import parse_node
 from maas_common import print_output
+from maas_common import record_sample
 from maas_common import status_err
 from maas_common import status_ok
 
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+MYSQL = os.environ.get('MAAS_MYSQL', '/usr/bin/mysql')
+MY_CNF = '/root/.my.cnf'
+QUERY = ("SHOW GLOBAL STATUS WHERE Variable_name REGEXP "
+         "'^(wsrep.*|queries|uptime)$'")
+TIMEOUT = 10
+# PyMySQL connections by (host, port, defaults file), kept across checks run
+# by maasd.py
+CONNECTIONS = {}
+# (status counter, rate metric, unit, scale) of the rates reported; the
+# flow control pause is reported in seconds paused per second
+RATES = [('Queries', 'queries_per_second', 'qps', 1),
+         ('wsrep_replicated_bytes', 'wsrep_replicated_bytes_per_second',
+          'bytes', 1),
+         ('wsrep_received_bytes', 'wsrep_received_bytes_per_second',
+          'bytes', 1),
+         ('wsrep_flow_control_paused_ns',
+          'wsrep_flow_control_paused_per_second', 'seconds', 1e-9),
+         ('wsrep_local_cert_failures',
+          'wsrep_local_cert_failures_per_second', 'failures', 1)]
+# in cluster mode, a node whose receive queue is longer than both of these
+# is reported as lagging: a multiple of the median queue of the cluster and
+# a minimum number of write sets
+RECV_QUEUE_FACTOR = 4
+RECV_QUEUE_FLOOR = 16
+# metrics printed for each of several nodes given with --nodes: the numeric
+# ones of print_metrics, without the rates
+NODE_METRICS = 4
+
+
+class GaleraError(Exception):
+    pass
+
 
 def galera_status_check(arg):
     proc = subprocess.Popen(shlex.split(arg),
@@ -35,7 +79,7 @@ def galera_status_check(arg):
     return ret, out, err
 
 
-def generate_query(host, port):
+def generate_query(host, port, defaults_file=MY_CNF):
     if host:
         host = ' -h %s' % host
     else:
@@ -46,9 +90,65 @@ def generate_query(host, port):
     else:
         port = ''
 
-    return ('/usr/bin/mysql --defaults-file=/root/.my.cnf'
-            '%s%s -e "SHOW STATUS WHERE Variable_name REGEXP '
-            "'^(wsrep.*|queries)'\"") % (host, port)
+    return ('%s --defaults-file=%s%s%s -e "%s"' %
+            (MYSQL, defaults_file, host, port, QUERY))
+
+
+def query_cli(host, port, defaults_file=MY_CNF):
+    """Return the status variables of a node, using the mysql client."""
+    retcode, output, err = galera_status_check(
+        generate_query(host, port, defaults_file))
+
+    if retcode > 0:
+        raise GaleraError(err.strip() or 'mysql exited with %d' % retcode)
+
+    if not output:
+        raise GaleraError('No output received from mysql. Cannot gather '
+                          'metrics.')
+
+    show_status_list = output.split('\n')[1:-1]
+    replica_status = {}
+    for i in show_status_list:
+        replica_status[i.split('\t')[0]] = i.split('\t')[1]
+    return replica_status
+
+
+def query_native(host, port, defaults_file=MY_CNF):
+    """Return the status variables of a node, using PyMySQL.
+
+    The credentials, and the host and port unless given, are read from the
+    [client] section of ``defaults_file`` as the mysql client would.
+    """
+    key = (host, port, defaults_file)
+    try:
+        connection = CONNECTIONS.get(key)
+        if connection is None:
+            kwargs = {'read_default_file': defaults_file,
+                      'connect_timeout': TIMEOUT}
+            if host:
+                kwargs['host'] = host
+            if port:
+                kwargs['port'] = int(port)
+            connection = CONNECTIONS[key] = pymysql.connect(**kwargs)
+        else:
+            connection.ping(reconnect=True)
+        cursor = connection.cursor()
+        try:
+            cursor.execute(QUERY)
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
+    except pymysql.Error as e:
+        CONNECTIONS.pop(key, None)
+        raise GaleraError(str(e))
+
+
+def query_node(node, cli=False, defaults_file=MY_CNF):
+    """Return the status variables of ``node``."""
+    host, port = node
+    if pymysql is None or cli:
+        return query_cli(host, port, defaults_file)
+    return query_native(host, port, defaults_file)
 
 
 def parse_args():
@@ -57,61 +157,200 @@ def parse_args():
                       default=None,
                       help='Host to override the defaults with')
     parser.add_option('-P', '--port', action='store', dest='port',
-                      default=None,
+                      type='int', default=None,
                       help='Port to override the defauults with')
+    parser.add_option('--nodes', action='store', dest='nodes',
+                      default=None,
+                      help='Comma separated HOST[:PORT] list of nodes to '
+                           'query in parallel instead of a single one')
+    parser.add_option('--cluster', action='store_true', dest='cluster',
+                      default=False,
+                      help='Check the consistency of the whole cluster '
+                           'given with --nodes instead of each node')
+    parser.add_option('--cli', action='store_true', dest='cli',
+                      default=False,
+                      help='Query through the mysql client even when '
+                           'PyMySQL is available')
+    parser.add_option('--defaults-file', action='store',
+                      dest='defaults_file', default=MY_CNF,
+                      help='Option file whose [client] section holds the '
+                           'credentials, as for the mysql client')
     return parser.parse_args()
 
 
-def print_metrics(replica_status):
+def node_rates(node, replica_status):
+    """Return the rates of the RATES counters since the previous runs.
+
+    The counters are kept in a history per node; Uptime going down tells
+    that the node restarted and reset all of them.
+    """
+    host, port = node
+    counters = dict((name, int(replica_status[name]))
+                    for name in [r[0] for r in RATES] + ['Uptime']
+                    if name in replica_status)
+    history = record_sample(
+        history_path('galera_check', host or 'localhost', port or 3306),
+        counters)
+    return counter_rates(history, uptime='Uptime')
+
+
+def print_metrics(replica_status, rates, suffix=''):
     status_ok()
-    metric('wsrep_replicated_bytes', 'int64',
+    metric('wsrep_replicated_bytes' + suffix, 'int64',
            replica_status['wsrep_replicated_bytes'], 'bytes')
-    metric('wsrep_received_bytes', 'int64',
+    metric('wsrep_received_bytes' + suffix, 'int64',
            replica_status['wsrep_received_bytes'], 'bytes')
-    metric('wsrep_commit_window_size', 'double',
+    metric('wsrep_commit_window_size' + suffix, 'double',
            replica_status['wsrep_commit_window'], 'sequence_delta')
-    metric('wsrep_cluster_size', 'int64',
+    metric('wsrep_cluster_size' + suffix, 'int64',
            replica_status['wsrep_cluster_size'], 'nodes')
-    metric('queries_per_second', 'int64',
-           replica_status['Queries'], 'qps')
-    metric('wsrep_cluster_state_uuid', 'string',
-           replica_status['wsrep_cluster_state_uuid'])
-    metric('wsrep_cluster_status', 'string',
-           replica_status['wsrep_cluster_status'])
-    metric('wsrep_local_state_uuid', 'string',
-           replica_status['wsrep_local_state_uuid'])
-    metric('wsrep_local_state_comment', 'string',
-           replica_status['wsrep_local_state_comment'])
+    if not suffix:
+        # with several nodes these would use up the metric budget, and the
+        # check already failed unless they have the values expected
+        metric('wsrep_cluster_state_uuid', 'string',
+               replica_status['wsrep_cluster_state_uuid'])
+        metric('wsrep_cluster_status', 'string',
+               replica_status['wsrep_cluster_status'])
+        metric('wsrep_local_state_uuid', 'string',
+               replica_status['wsrep_local_state_uuid'])
+        metric('wsrep_local_state_comment', 'string',
+               replica_status['wsrep_local_state_comment'])
+    # the rates are known from the second run on
+    for counter, name, unit, scale in RATES:
+        if counter in rates:
+            metric(name + suffix, 'double', '%.3f' % (rates[counter] * scale),
+                   unit)
+
+
+def check_node(replica_status, prefix=''):
+    if replica_status['wsrep_cluster_status'] != "Primary":
+        status_err(prefix + "there is a partition in the cluster")
+
+    if (replica_status['wsrep_local_state_uuid'] !=
+            replica_status['wsrep_cluster_state_uuid']):
+        status_err(prefix + "the local node is out of sync")
+
+
+def check_cluster(nodes, results):
+    """Compare the status of all the nodes of a cluster.
+
+    Only the nodes being unreachable or disagreeing on the cluster state
+    make the check fail; everything else is left to the alarms.
+    """
+    reachable = []
+    errors = []
+    for (host, port), result in zip(nodes, results):
+        if isinstance(result, Exception):
+            errors.append('%s: %s' % (host, result))
+        else:
+            reachable.append(((host, port), result))
+    if not reachable:
+        status_err('no node reachable, ' + '; '.join(errors))
+
+    # nodes in different primary components means a split brain
+    primary = [(node, replica_status) for node, replica_status in reachable
+               if replica_status['wsrep_cluster_status'] == 'Primary']
+    components = {}
+    for (host, _), replica_status in primary:
+        components.setdefault(replica_status['wsrep_cluster_state_uuid'],
+                              []).append(host)
+    if len(components) > 1:
+        status_err('split brain, ' + '; '.join(
+            '%s in %s' % (', '.join(hosts), uuid)
+            for uuid, hosts in sorted(components.items())))
+
+    rates = [node_rates(node, replica_status)
+             for node, replica_status in reachable]
+    committed = [int(replica_status['wsrep_last_committed'])
+                 for _, replica_status in primary]
+    recv_queues = dict((host, int(replica_status['wsrep_local_recv_queue']))
+                       for (host, _), replica_status in reachable)
+    median = sorted(recv_queues.values())[len(recv_queues) // 2]
+    lagging = sorted(host for host, queue in recv_queues.items()
+                     if queue > max(RECV_QUEUE_FLOOR,
+                                    RECV_QUEUE_FACTOR * median))
+
+    problems = []
+    if errors:
+        problems.append('unreachable ' + '; '.join(errors))
+    if lagging:
+        problems.append('lagging ' + ', '.join(lagging))
+    status_ok('; '.join(problems) or None)
+
+    metric('galera_cluster_nodes', 'uint32', len(nodes), 'nodes')
+    metric('galera_cluster_nodes_reachable', 'uint32', len(reachable),
+           'nodes')
+    metric('galera_cluster_nodes_primary', 'uint32', len(primary), 'nodes')
+    metric('galera_cluster_nodes_synced', 'uint32',
+           sum(1 for _, replica_status in reachable
+               if replica_status['wsrep_local_state_comment'] == 'Synced'),
+           'nodes')
+    metric('galera_cluster_size_min', 'uint32',
+           min(int(replica_status['wsrep_cluster_size'])
+               for _, replica_status in reachable), 'nodes')
+    if committed:
+        metric('galera_last_committed_spread', 'int64',
+               max(committed) - min(committed), 'transactions')
+    metric('galera_recv_queue_max', 'int64', max(recv_queues.values()),
+           'writesets')
+    metric('galera_recv_queue_lagging_nodes', 'uint32', len(lagging),
+           'nodes')
+
+    # the rates are known from the second run on
+    paused = [node['wsrep_flow_control_paused_ns'] * 1e-9 for node in rates
+              if 'wsrep_flow_control_paused_ns' in node]
+    if paused:
+        metric('galera_flow_control_paused_max', 'double',
+               '%.3f' % max(paused), 'seconds')
+    queries = [node['Queries'] for node in rates if 'Queries' in node]
+    if queries:
+        metric('galera_cluster_queries_per_second', 'double',
+               '%.3f' % sum(queries), 'qps')
 
 
 def main():
     options, _ = parse_args()
 
-    retcode, output, err = galera_status_check(
-        generate_query(options.host, options.port)
-    )
+    if options.cluster and not options.nodes:
+        status_err('--cluster needs the nodes given with --nodes')
 
-    if retcode > 0:
-        status_err(err)
+    if options.nodes is not None:
+        nodes = [parse_node(spec, options.port)
+                 for spec in options.nodes.split(',') if spec.strip()]
+        if not nodes:
+            status_err('--nodes lists no galera node')
+    else:
+        nodes = [(options.host, options.port)]
 
-    if not output:
-        status_err('No output received from mysql. Cannot gather metrics.')
+    multiple = len(nodes) > 1
+    if (multiple and not options.cluster and
+            len(nodes) * NODE_METRICS > MAX_METRICS):
+        status_err('%d nodes would print more than %d metrics, use --cluster'
+                   % (len(nodes), MAX_METRICS))
 
-    show_status_list = output.split('\n')[1:-1]
-    replica_status = {}
-    for i in show_status_list:
-        replica_status[i.split('\t')[0]] = i.split('\t')[1]
+    results = fan_out(
+        lambda node: query_node(node, options.cli, options.defaults_file),
+        nodes)
 
-    if replica_status['wsrep_cluster_status'] != "Primary":
-        status_err("there is a partition in the cluster")
+    if options.cluster:
+        check_cluster(nodes, results)
+        return
 
-    if (replica_status['wsrep_local_state_uuid'] !=
-            replica_status['wsrep_cluster_state_uuid']):
-        status_err("the local node is out of sync")
+    # the metrics of each node are told apart by its address
+    for (host, _), result in zip(nodes, results):
+        prefix = '%s: ' % host if multiple else ''
+        if isinstance(result, Exception):
+            status_err(prefix + str(result))
+        check_node(result, prefix)
 
-    if (int(replica_status['wsrep_local_state']) == 4 and
-            replica_status['wsrep_local_state_comment'] == "Synced"):
-        print_metrics(replica_status)
+    for node, replica_status in zip(nodes, results):
+        # the rates of several nodes would use up the metric budget, the
+        # cluster mode reports them for the whole cluster
+        rates = {} if multiple else node_rates(node, replica_status)
+        if (int(replica_status['wsrep_local_state']) == 4 and
+                replica_status['wsrep_local_state_comment'] == "Synced"):
+            print_metrics(replica_status, rates,
+                          '_%s' % node[0] if multiple else '')
 
 
 if __name__ == '__main__':
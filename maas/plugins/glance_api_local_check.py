@@ -19,30 +19,22 @@ import collections
 
 import ipaddr
 from maas_common import get_auth_ref
-from maas_common import get_keystone_client
+from maas_common import get_requests_session
+from maas_common import json_values
 from maas_common import metric
 from maas_common import metric_bool
 from maas_common import print_output
 from maas_common import status_err
 from maas_common import status_ok
-import requests
 from requests import exceptions as exc
 
 IMAGE_STATUSES = ['active', 'queued', 'killed']
 
 
 def check(auth_ref, args):
-    # We call get_keystone_client here as there is some logic within to get a
-    # new token if previous one is bad.
-    keystone = get_keystone_client(auth_ref)
-    auth_token = keystone.auth_token
     api_endpoint = 'http://{ip}:9292/v1'.format(ip=args.ip)
 
-    s = requests.Session()
-
-    s.headers.update(
-        {'Content-type': 'application/json',
-         'x-auth-token': auth_token})
+    s = get_requests_session(auth_ref['auth_token'])
 
     try:
         # Hit something that isn't querying the glance-registry, since we
@@ -59,12 +51,12 @@ def check(auth_ref, args):
         # gather some metrics to report
         try:
             r = s.get('%s/images/detail' % api_endpoint, verify=False,
-                      timeout=10)
+                      timeout=10, stream=True)
+            # count the statuses as the images arrive
+            status_count = collections.Counter(
+                json_values(r, 'images.item.status'))
         except Exception as e:
             status_err(str(e))
-        else:
-            image_statuses = [i['status'] for i in r.json()['images']]
-            status_count = collections.Counter(image_statuses)
 
     status_ok()
     metric_bool('glance_api_local_status', is_up)
@@ -18,28 +18,19 @@ import argparse
 
 import ipaddr
 from maas_common import get_auth_ref
-from maas_common import get_keystone_client
+from maas_common import get_requests_session
 from maas_common import metric
 from maas_common import metric_bool
 from maas_common import print_output
 from maas_common import status_err
 from maas_common import status_ok
-import requests
 from requests import exceptions as exc
 
 
 def check(auth_ref, args):
-    # We call get_keystone_client here as there is some logic within to get a
-    # new token if previous one is bad.
-    keystone = get_keystone_client(auth_ref)
-    auth_token = keystone.auth_token
     registry_endpoint = 'http://{ip}:9191'.format(ip=args.ip)
 
-    s = requests.Session()
-
-    s.headers.update(
-        {'Content-type': 'application/json',
-         'x-auth-token': auth_token})
+    s = get_requests_session(auth_ref['auth_token'])
 
     try:
         # /images returns a list of public, non-deleted images
@@ -35,18 +35,17 @@ def check(args, tenant_id):
 
     try:
         heat = get_heat_client(endpoint=HEAT_ENDPOINT)
+        # time something arbitrary
+        start = time.time()
+        heat.build_info.build_info()
+        end = time.time()
+        milliseconds = (end - start) * 1000
         is_up = True
     except exc.HTTPException as e:
         is_up = False
     # Any other exception presumably isn't an API error
     except Exception as e:
         status_err(str(e))
-    else:
-        # time something arbitrary
-        start = time.time()
-        heat.build_info.build_info()
-        end = time.time()
-        milliseconds = (end - start) * 1000
 
     status_ok()
     metric_bool('heat_api_local_status', is_up)
@@ -15,331 +15,462 @@
 # limitations under the License.
 from __future__ import print_function
 
+import collections
 import contextlib
 import datetime
 import errno
+import fcntl
+import functools
+import hashlib
 import json
 import logging
+import math
 import os
 import re
+import resource
+import socket
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import traceback
 
 AUTH_DETAILS = {'OS_USERNAME': None,
                 'OS_PASSWORD': None,
                 'OS_TENANT_NAME': None,
                 'OS_AUTH_URL': None}
+# auth details which may be left unset
+OPTIONAL_AUTH_DETAILS = {'OS_REGION_NAME': None}
+
+# Overridable so that the plugins can be run against fakes, see
+# maas/testing/bench_plugins.py.
+OPENRC = os.environ.get('MAAS_OPENRC', '/root/openrc-maas')
+TOKEN_FILE = os.environ.get('MAAS_TOKEN_FILE', '/root/.auth_ref.json')
+TOKEN_LOCK_FILE = TOKEN_FILE + '.lock'
+# Seconds before expires_at at which the token is replaced, so that a token
+# never expires underneath the plugins sharing it.
+TOKEN_REFRESH_MARGIN = int(os.environ.get('MAAS_TOKEN_REFRESH_MARGIN', 300))
+# Seconds to wait for another plugin to finish refreshing the token.
+TOKEN_LOCK_TIMEOUT = 20
+# Bumped whenever the layout of the cluster snapshots changes, so that checks
+# never read a snapshot published by a different version of the plugins.
+SNAPSHOT_VERSION = 1
+# Seconds a cluster snapshot publisher may hold its memcached lock.
+SNAPSHOT_LOCK_TIMEOUT = 60
+
+# Only populated when the plugins are run in-process by maasd.py, where the
+# module lives across check runs. A forked plugin starts with empty caches.
+AUTH_REF = None
+CLIENTS = {}
+# (service catalog, index of that catalog) for the last catalog looked up
+CATALOG_INDEX = (None, None)
+# interface names used by keystone v2 catalogs
+V2_INTERFACES = {'publicURL': 'public',
+                 'internalURL': 'internal',
+                 'adminURL': 'admin'}
+
+# Where print_output reports the profile of the check: a comma separated
+# list of metrics and log. Empty disables the report.
+PROFILE_OUTPUT = os.environ.get('MAAS_PROFILE', '')
+PROFILE_LOG_FILE = '/var/log/maas_plugins.log'
+# seconds spent in each phase of the check, excluding nested phases, summed
+# over all threads
+PHASES = collections.OrderedDict()
+PROFILE_LOCK = threading.Lock()
+# the phases each thread is in
+PHASE_STACKS = threading.local()
+COUNTERS = {'subprocesses': 0, 'bytes_received': 0}
 
-OPENRC = '/root/openrc-maas'
-TOKEN_FILE = '/root/.auth_ref.json'
 
+@contextlib.contextmanager
+def phase(name):
+    """Count the time spent in the block towards phase ``name``.
+
+    Time spent in a phase nested within the block is only counted towards
+    the nested phase.
+    """
+    stack = PHASE_STACKS.__dict__.setdefault('stack', [])
+    entry = [name, time.time(), 0.0]
+    stack.append(entry)
+    try:
+        yield
+    finally:
+        stack.pop()
+        elapsed = time.time() - entry[1]
+        with PROFILE_LOCK:
+            PHASES[name] = PHASES.get(name, 0.0) + elapsed - entry[2]
+        if stack:
+            stack[-1][2] += elapsed
+
+
+def profiled(name):
+    """Decorate a function whose calls make up phase ``name``."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@profiled('client')
+def get_cinder_client():
+    try:
+        from cinderclient import client as c_client
+        from cinderclient import exceptions as c_exc
+    except ImportError:
+        status_err('Cannot import cinderclient')
 
-try:
-    from cinderclient import client as c_client
-    from cinderclient import exceptions as c_exc
+    # right now, cinderclient does not accept a previously derived token
+    # or endpoint url. So we have to pass it creds and let it do it's own
+    # auth each time it's called.
+    # NOTE: (mancdaz) update when https://review.openstack.org/#/c/74602/
+    # lands
+    auth_details = get_auth_details()
 
-except ImportError:
-    def get_cinder_client(*args, **kwargs):
-        status_err('Cannot import cinderclient')
-else:
+    def build(auth_ref=None):
+        key = ('cinder', auth_details['OS_USERNAME'],
+               auth_details['OS_AUTH_URL'])
+        if auth_ref is not None:
+            # the client authenticates itself, with the token rejected
+            CLIENTS.pop(key, None)
+        return cached_client(key, c_client.Client, '2',
+                             auth_details['OS_USERNAME'],
+                             auth_details['OS_PASSWORD'],
+                             auth_details['OS_TENANT_NAME'],
+                             auth_details['OS_AUTH_URL'])
 
-    def get_cinder_client(previous_tries=0):
-        if previous_tries > 3:
-            return None
-        # right now, cinderclient does not accept a previously derived token
-        # or endpoint url. So we have to pass it creds and let it do it's own
-        # auth each time it's called.
-        # NOTE: (mancdaz) update when https://review.openstack.org/#/c/74602/
-        # lands
-
-        auth_details = get_auth_details()
-        cinder = c_client.Client('2',
-                                 auth_details['OS_USERNAME'],
-                                 auth_details['OS_PASSWORD'],
-                                 auth_details['OS_TENANT_NAME'],
-                                 auth_details['OS_AUTH_URL'])
+    return AuthRetryProxy(build(), build,
+                          (c_exc.Unauthorized, c_exc.AuthorizationFailure))
 
-        try:
-            # Do something just to ensure we actually have auth'd ok
-            volumes = cinder.volumes.list()
-            # Exceptions are only thrown when we iterate over volumes
-            [i.id for i in volumes]
-        except (c_exc.Unauthorized, c_exc.AuthorizationFailure) as e:
-            cinder = get_cinder_client(previous_tries + 1)
-        except Exception as e:
-            status_err(str(e))
-
-        return cinder
-
-try:
-    import glanceclient as g_client
-    from glanceclient import exc as g_exc
-except ImportError:
-    def get_glance_client(*args, **kwargs):
+
+@profiled('client')
+def get_glance_client(token=None, endpoint=None):
+    try:
+        import glanceclient as g_client
+        from glanceclient import exc as g_exc
+    except ImportError:
         status_err('Cannot import glanceclient')
-else:
-    def get_glance_client(token=None, endpoint=None, previous_tries=0):
-        if previous_tries > 3:
-            return None
 
-        # first try to use auth details from auth_ref so we
-        # don't need to auth with keystone every time
-        auth_ref = get_auth_ref()
+    # first try to use auth details from auth_ref so we
+    # don't need to auth with keystone every time
+    auth_ref = get_auth_ref()
 
-        if not token:
-            token = auth_ref['auth_token']
-        if not endpoint:
-            endpoint = get_endpoint_url_for_service(
-                'image',
-                auth_ref['catalog'])
+    if not token:
+        token = auth_ref['auth_token']
+    if not endpoint:
+        endpoint = get_endpoint_url_for_service(
+            'image',
+            get_service_catalog(auth_ref),
+            region=get_region())
 
-        glance = g_client.Client('1', endpoint=endpoint, token=token)
+    def build(token):
+        return cached_client(('glance', token, endpoint), g_client.Client,
+                             '1', endpoint=endpoint, token=token)
 
-        try:
-            # We don't want to be pulling massive lists of images every time we
-            # run
-            image = glance.images.list(limit=1)
-            # Exceptions are only thrown when we iterate over image
-            [i.id for i in image]
-        except g_exc.HTTPUnauthorized:
-            auth_ref = force_reauth()
-            token = auth_ref['auth_token']
-
-            glance = get_glance_client(token, endpoint, previous_tries + 1)
-        # we only want to pass HTTPException back to the calling poller
-        # since this encapsulates all of our actual API failures. Other
-        # exceptions will be treated as script/environmental issues and
-        # sent to status_err
-        except g_exc.HTTPException:
-            raise
-        except Exception as e:
-            status_err(str(e))
-
-        return glance
-
-try:
-    from novaclient import client as nova_client
-    from novaclient.client import exceptions as nova_exc
-except ImportError:
-    def get_nova_client(*args, **kwargs):
+    # HTTPException is left for the calling poller since this encapsulates
+    # all of our actual API failures
+    return AuthRetryProxy(build(token),
+                          lambda auth_ref: build(auth_ref['auth_token']),
+                          g_exc.HTTPUnauthorized)
+
+
+@profiled('client')
+def get_nova_client(auth_token=None, bypass_url=None):
+    try:
+        from novaclient import client as nova_client
+        from novaclient.client import exceptions as nova_exc
+    except ImportError:
         status_err('Cannot import novaclient')
-else:
-    def get_nova_client(auth_token=None, bypass_url=None, previous_tries=0):
-        if previous_tries > 3:
-            return None
 
-        # first try to use auth details from auth_ref so we
-        # don't need to auth with keystone every time
-        auth_ref = get_auth_ref()
+    # first try to use auth details from auth_ref so we
+    # don't need to auth with keystone every time
+    auth_ref = get_auth_ref()
+
+    if not auth_token:
+        auth_token = auth_ref['auth_token']
+    if not bypass_url:
+        bypass_url = get_endpoint_url_for_service(
+            'compute',
+            get_service_catalog(auth_ref),
+            region=get_region())
+
+    def build(auth_token):
+        return cached_client(('nova', auth_token, bypass_url),
+                             nova_client.Client, '2', auth_token=auth_token,
+                             bypass_url=bypass_url)
+
+    # NOTE(mancdaz)nova doesn't properly pass back unauth errors, but
+    # in fact tries to re-auth, all by itself. But we didn't pass it
+    # an auth_url, so it bombs out horribly with an
+    # Attribute error. This is a bug, to be filed...
+    return AuthRetryProxy(build(auth_token),
+                          lambda auth_ref: build(auth_ref['auth_token']),
+                          (AttributeError, nova_exc.Unauthorized),
+                          is_auth_error=nova_reauth_failed)
+
+
+def nova_reauth_failed(error, tb):
+    """Tell whether ``error`` tells that nova rejected the token.
+
+    Any Unauthorized does. An AttributeError only does when it was raised
+    while novaclient authenticated again by itself, without an auth_url;
+    elsewhere it is a plain bug and is not retried.
+    """
+    if not isinstance(error, AttributeError):
+        return True
+    return any(name == 'authenticate' and 'novaclient' in filename
+               for filename, _, name, _ in traceback.extract_tb(tb))
+
+
+def keystone_auth(auth_details):
+    global AUTH_REF, CATALOG_INDEX
+    try:
+        from keystoneclient.v2_0 import client as k2_client
+        from keystoneclient.v3 import client as k3_client
+    except ImportError:
+        status_err('Cannot import keystoneclient')
+
+    try:
+        if auth_details['OS_AUTH_URL'].endswith('v3'):
+            k_client = k3_client
+        else:
+            k_client = k2_client
+        tenant_name = auth_details['OS_TENANT_NAME']
+        keystone = k_client.Client(username=auth_details['OS_USERNAME'],
+                                   password=auth_details['OS_PASSWORD'],
+                                   tenant_name=tenant_name,
+                                   auth_url=auth_details['OS_AUTH_URL'])
+    except Exception as e:
+        status_err(str(e))
+
+    # the catalog index is stored with the token so that other plugins
+    # don't have to build it again
+    catalog = get_service_catalog(keystone.auth_ref)
+    CATALOG_INDEX = (catalog, catalog_index(catalog))
+    token_data = dict(keystone.auth_ref)
+    token_data['maas_catalog_index'] = CATALOG_INDEX[1]
+    try:
+        write_json_atomic(TOKEN_FILE, token_data)
+    except (IOError, OSError):
+        # if we can't write the file we go on
+        pass
 
-        if not auth_token:
-            auth_token = auth_ref['auth_token']
-        if not bypass_url:
-            bypass_url = get_endpoint_url_for_service(
-                'compute',
-                auth_ref['catalog'])
+    # clients built around the previous token are of no further use
+    AUTH_REF = keystone.auth_ref
+    CLIENTS.clear()
+    return keystone.auth_ref
 
-        nova = nova_client.Client('2', auth_token=auth_token,
-                                  bypass_url=bypass_url)
 
-        try:
-            flavors = nova.flavors.list()
-            # Exceptions are only thrown when we try and do something
-            [flavor.id for flavor in flavors]
-
-        # except (nova_exc.Unauthorized, nova_exc.AuthorizationFailure) as e:
-        # NOTE(mancdaz)nova doesn't properly pass back unauth errors, but
-        # in fact tries to re-auth, all by itself. But we didn't pass it
-        # an auth_url, so it bombs out horribly with an
-        # Attribute error. This is a bug, to be filed...
-
-        except AttributeError:
-            auth_ref = force_reauth()
-            auth_token = auth_ref['auth_token']
-
-            nova = get_nova_client(auth_token, bypass_url, previous_tries + 1)
-
-        # we only want to pass ClientException back to the calling poller
-        # since this encapsulates all of our actual API failures. Other
-        # exceptions will be treated as script/environmental issues and
-        # sent to status_err
-        except nova_exc.ClientException:
-            raise
-        except Exception as e:
-            status_err(str(e))
-
-        return nova
-
-try:
-    from keystoneclient.openstack.common.apiclient import exceptions as k_exc
-    from keystoneclient.v2_0 import client as k2_client
-    from keystoneclient.v3 import client as k3_client
-except ImportError:
-    def keystone_auth(*args, **kwargs):
+@profiled('client')
+def get_keystone_client(auth_ref=None, endpoint=None):
+    try:
+        from keystoneclient.openstack.common.apiclient import (
+            exceptions as k_exc)
+        from keystoneclient.v2_0 import client as k2_client
+        from keystoneclient.v3 import client as k3_client
+    except ImportError:
         status_err('Cannot import keystoneclient')
 
-    def get_keystone_client(*args, **kwargs):
-        status_err('Cannot import keystoneclient')
-else:
-    def keystone_auth(auth_details):
-        try:
-            if auth_details['OS_AUTH_URL'].endswith('v3'):
-                k_client = k3_client
-            else:
-                k_client = k2_client
-            tenant_name = auth_details['OS_TENANT_NAME']
-            keystone = k_client.Client(username=auth_details['OS_USERNAME'],
-                                       password=auth_details['OS_PASSWORD'],
-                                       tenant_name=tenant_name,
-                                       auth_url=auth_details['OS_AUTH_URL'])
-        except Exception as e:
-            status_err(str(e))
+    # first try to use auth details from auth_ref so we
+    # don't need to auth with keystone every time
+    if not auth_ref:
+        auth_ref = get_auth_ref()
 
-        try:
-            with open(TOKEN_FILE, 'w') as token_file:
-                json.dump(keystone.auth_ref, token_file)
-        except IOError:
-            # if we can't write the file we go on
-            pass
+    auth_version = auth_ref['version']
+    if not endpoint:
+        endpoint = get_endpoint_url_for_service('identity',
+                                                get_service_catalog(auth_ref),
+                                                'admin',
+                                                version=auth_version,
+                                                region=get_region())
+    if auth_version == 'v3':
+        k_client = k3_client
+    else:
+        k_client = k2_client
 
-        return keystone.auth_ref
+    def build(auth_ref):
+        key = ('keystone', auth_ref['auth_token'], endpoint)
+        return cached_client(key, k_client.Client, auth_ref=auth_ref,
+                             endpoint=endpoint)
 
-    def get_keystone_client(auth_ref=None, endpoint=None, previous_tries=0):
-        if previous_tries > 3:
-            return None
+    return AuthRetryProxy(build(auth_ref), build,
+                          (k_exc.AuthorizationFailure, k_exc.Unauthorized))
 
-        # first try to use auth details from auth_ref so we
-        # don't need to auth with keystone every time
-        if not auth_ref:
-            auth_ref = get_auth_ref()
-
-        auth_version = auth_ref['version']
-        if not endpoint:
-            endpoint = get_endpoint_url_for_service('identity',
-                                                    auth_ref['catalog'],
-                                                    'admin',
-                                                    version=auth_version)
-        if auth_version == 'v3':
-            k_client = k3_client
-        else:
-            k_client = k2_client
-        keystone = k_client.Client(auth_ref=auth_ref, endpoint=endpoint)
 
-        try:
-            # This should be a rather light-weight call that validates we're
-            # actually connected/authenticated.
-            keystone.services.list()
-        except (k_exc.AuthorizationFailure, k_exc.Unauthorized):
-            # Force an update of auth_ref
-            auth_ref = force_reauth()
-            keystone = get_keystone_client(auth_ref,
-                                           endpoint,
-                                           previous_tries + 1)
-        except (k_exc.HttpServerError, k_exc.ClientException):
-            raise
-        except Exception as e:
-            status_err(str(e))
-
-        return keystone
-
-
-try:
-    from neutronclient.common import exceptions as n_exc
-    from neutronclient.neutron import client as n_client
-except ImportError:
-    def get_neutron_client(*args, **kwargs):
+@profiled('client')
+def get_neutron_client(token=None, endpoint_url=None):
+    try:
+        from neutronclient.common import exceptions as n_exc
+        from neutronclient.neutron import client as n_client
+    except ImportError:
         status_err('Cannot import neutronclient')
-else:
-    def get_neutron_client(token=None, endpoint_url=None, previous_tries=0):
-        if previous_tries > 3:
-            return None
 
-        # first try to use auth details from auth_ref so we
-        # don't need to auth with keystone every time
-        auth_ref = get_auth_ref()
+    # first try to use auth details from auth_ref so we
+    # don't need to auth with keystone every time
+    auth_ref = get_auth_ref()
+
+    if not token:
+        token = auth_ref['auth_token']
+    if not endpoint_url:
+        endpoint_url = get_endpoint_url_for_service(
+            'network',
+            get_service_catalog(auth_ref),
+            region=get_region())
+
+    def build(token):
+        return cached_client(('neutron', token, endpoint_url),
+                             n_client.Client, '2.0', token=token,
+                             endpoint_url=endpoint_url)
+
+    # if we have provided a bum token, neutron wants to try and reauth
+    # itself but it can't as we didn't provide it an auth_url and all that
+    # jazz. Since we want to auth again ourselves (so we can update our
+    # local token) we catch the exception it throws instead
+    return AuthRetryProxy(build(token),
+                          lambda auth_ref: build(auth_ref['auth_token']),
+                          (n_exc.NoAuthURLProvided, n_exc.Unauthorized))
+
+
+@profiled('client')
+def get_heat_client(token=None, endpoint=None):
+    try:
+        from heatclient import client as heat_client
+        from heatclient import exc as h_exc
+    except ImportError:
+        status_err('Cannot import heatclient')
 
-        if not token:
-            token = auth_ref['auth_token']
-        if not endpoint_url:
-            endpoint_url = get_endpoint_url_for_service(
-                'network',
-                auth_ref['catalog'])
+    # first try to use auth details from auth_ref so we
+    # don't need to auth with keystone every time
+    auth_ref = get_auth_ref()
 
-        neutron = n_client.Client('2.0',
-                                  token=token,
-                                  endpoint_url=endpoint_url)
+    if not token:
+        token = auth_ref['auth_token']
+    if not endpoint:
+        endpoint = get_endpoint_url_for_service(
+            'orchestration',
+            get_service_catalog(auth_ref),
+            region=get_region())
 
-        try:
-            # some arbitrary command that should always have at least 1 result
-            agents = neutron.list_agents()
-            # iterate the list to ensure we actually have something
-            [i['id'] for i in agents['agents']]
-
-        # if we have provided a bum token, neutron wants to try and reauth
-        # itself but it can't as we didn't provide it an auth_url and all that
-        # jazz. Since we want to auth again ourselves (so we can update our
-        # local token) we'll just catch the exception it throws and move on
-        except n_exc.NoAuthURLProvided:
-            auth_ref = force_reauth()
-            token = auth_ref['auth_token']
-
-            neutron = get_neutron_client(token, endpoint_url,
-                                         previous_tries + 1)
-
-        # we only want to pass NeutronClientException back to the caller
-        # since this encapsulates all of our actual API failures. Other
-        # exceptions will be treated as script/environmental issues and
-        # sent to status_err
-        except n_exc.NeutronClientException as e:
-            raise
-        except Exception as e:
-            status_err(str(e))
-
-        return neutron
-
-
-try:
-    from heatclient import client as heat_client
-    from heatclient import exc as h_exc
-except ImportError:
-    def get_heat_client(*args, **kwargs):
-        status_err('Cannot import heatclient')
-else:
-    def get_heat_client(token=None, endpoint=None, previous_tries=0):
-        if previous_tries > 3:
-            return None
+    def build(token):
+        return cached_client(('heat', token, endpoint), heat_client.Client,
+                             '1', endpoint=endpoint, token=token)
 
-        # first try to use auth details from auth_ref so we
-        # don't need to auth with keystone every time
-        auth_ref = get_auth_ref()
+    return AuthRetryProxy(build(token),
+                          lambda auth_ref: build(auth_ref['auth_token']),
+                          h_exc.HTTPUnauthorized)
 
-        if not token:
-            token = auth_ref['auth_token']
-        if not endpoint:
-            endpoint = get_endpoint_url_for_service(
-                'orchestration',
-                auth_ref['catalog'])
 
-        heat = heat_client.Client('1', endpoint=endpoint, token=token)
-        try:
-            heat.build_info.build_info()
-        except h_exc.HTTPUnauthorized:
-            auth_ref = force_reauth()
-            token = auth_ref['auth_token']
-            heat = get_heat_client(token, endpoint, previous_tries + 1)
-        except h_exc.HTTPException:
-            raise
-        except Exception as e:
-            status_err(str(e))
+@profiled('client')
+def get_requests_session(auth_token=None):
+    """Return a requests session that sends the shared keystone token.
+
+    A request answered with 401 is retried once with a fresh token.
+    """
+    try:
+        import requests
+    except ImportError:
+        status_err('Cannot import requests')
 
-        return heat
+    if not auth_token:
+        auth_token = get_auth_ref()['auth_token']
+
+    session = requests.Session()
+    session.headers.update({'Content-type': 'application/json',
+                            'x-auth-token': auth_token})
+
+    def reauth(response, *args, **kwargs):
+        if (response.status_code != 401 or
+                getattr(response.request, 'maas_retried', False)):
+            return response
+        token = force_reauth()['auth_token']
+        session.headers['x-auth-token'] = token
+        request = response.request.copy()
+        request.headers['x-auth-token'] = token
+        request.maas_retried = True
+        return session.send(request, **kwargs)
+
+    session.hooks['response'].append(reauth)
+    session.request = profiled('api')(session.request)
+    return session
 
 
 class MaaSException(Exception):
     """Base MaaS plugin exception."""
 
 
-def is_token_expired(token):
+class AuthRetryProxy(object):
+    """Stand in for a client whose token has not been validated.
+
+    Attribute lookups and calls are passed through to the client. When a call
+    fails with one of ``auth_errors`` the token is renewed with
+    force_reauth(), the client is replaced by ``rebuild(auth_ref)`` and the
+    call is retried once. This saves the plugins a validation request before
+    every real one. Listings such as glance's images.list() only make their
+    requests as they are iterated, so iterators are read into a list within
+    the call. When given, ``is_auth_error(error, traceback)`` further tells
+    which of ``auth_errors`` are retried. get_requests_session() does the same
+    for the plugins that call the APIs directly, so none of them has to check
+    its token first.
+    """
+
+    def __init__(self, client, rebuild, auth_errors, is_auth_error=None,
+                 _path=(), _state=None):
+        self._state = _state if _state is not None else {'client': client}
+        self._rebuild = rebuild
+        self._auth_errors = auth_errors
+        self._is_auth_error = is_auth_error
+        self._path = _path
+
+    def _target(self):
+        target = self._state['client']
+        for name in self._path:
+            target = getattr(target, name)
+        return target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target(), name)
+        # plain values such as auth_token are handed out as they are
+        if (isinstance(attr, (dict, list, tuple)) or
+                not (callable(attr) or hasattr(attr, '__dict__'))):
+            return attr
+        return AuthRetryProxy(None, self._rebuild, self._auth_errors,
+                              self._is_auth_error, self._path + (name,),
+                              self._state)
+
+    def _call(self, *args, **kwargs):
+        result = self._target()(*args, **kwargs)
+        if isinstance(result, collections.Iterator):
+            result = list(result)
+        return result
+
+    @profiled('api')
+    def __call__(self, *args, **kwargs):
+        try:
+            return self._call(*args, **kwargs)
+        except self._auth_errors as e:
+            if self._state.get('retried'):
+                raise
+            if (self._is_auth_error and
+                    not self._is_auth_error(e, sys.exc_info()[2])):
+                raise
+            self._state['retried'] = True
+            self._state['client'] = self._rebuild(force_reauth())
+            return self._call(*args, **kwargs)
+
+
+def cached_client(key, client_class, *args, **kwargs):
+    """Return the client stored under ``key``, creating it if necessary."""
+    client = CLIENTS.get(key)
+    if client is None:
+        client = CLIENTS[key] = client_class(*args, **kwargs)
+    return client
+
+
+def is_token_expired(token, margin=0):
+    """Check whether ``token`` expires within ``margin`` seconds."""
     for fmt in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ'):
         try:
             expires = datetime.datetime.strptime(token['expires_at'], fmt)
@@ -348,27 +479,280 @@ def is_token_expired(token):
             pass
     else:
         raise e
-    return datetime.datetime.now() >= expires
+    # expires_at is always UTC
+    now = datetime.datetime.utcnow()
+    return now + datetime.timedelta(seconds=margin) >= expires
+
+
+def write_json_atomic(path, data):
+    """Replace ``path`` so that readers never see a partial file."""
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(data, tmp_file)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
 
+def read_json_file(path):
+    """Return the data stored at ``path``, or None if it is missing or
+    corrupt."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
 
+
+def import_ijson():
+    """Return the fastest ijson backend installed, or None."""
+    try:
+        # the C backend is an order of magnitude faster, when it is built
+        from ijson.backends import yajl2_c as ijson
+    except ImportError:
+        try:
+            import ijson
+        except ImportError:
+            ijson = None
+    return ijson
+
+
+def json_values(response, *prefixes):
+    """Yield the scalar values found at ``prefixes`` in a JSON response.
+
+    Prefixes use the ijson notation, where ``item`` stands for every element
+    of an array: ``images.item.status`` yields the status of each image.
+    When ijson is installed the body is parsed as it is read, so memory use
+    does not grow with the size of the response; request it with
+    ``stream=True``. Otherwise the whole body is loaded with
+    ``response.json()``.
+    """
+    ijson = import_ijson()
+    if ijson is None:
+        data = response.json()
+        for prefix in prefixes:
+            for value in walk_json(data, prefix.split('.')):
+                yield value
+        return
+
+    response.raw.decode_content = True
+    try:
+        for prefix, event, value in ijson.parse(response.raw):
+            if (prefix in prefixes and
+                    event in ('string', 'number', 'boolean', 'null')):
+                yield value
+    finally:
+        response.close()
+
+
+def json_items(response, prefix):
+    """Yield the objects found at ``prefix`` in a JSON response.
+
+    This is json_values for whole objects, such as each element of a
+    listing with ``item``: with ijson only one of them is held in memory at
+    a time.
+    """
+    ijson = import_ijson()
+    if ijson is None:
+        for value in walk_json(response.json(), prefix.split('.'),
+                               objects=True):
+            yield value
+        return
+
+    response.raw.decode_content = True
+    try:
+        for value in ijson.items(response.raw, prefix):
+            yield value
+    finally:
+        response.close()
+
+
+def walk_json(data, keys, objects=False):
+    """Yield the values of ``data`` at the ijson path ``keys``.
+
+    Only scalar values are yielded unless ``objects`` is true.
+    """
+    if not keys:
+        if objects or not isinstance(data, (dict, list)):
+            yield data
+    elif keys[0] == 'item':
+        if isinstance(data, list):
+            for element in data:
+                for value in walk_json(element, keys[1:], objects):
+                    yield value
+    elif isinstance(data, dict) and keys[0] in data:
+        for value in walk_json(data[keys[0]], keys[1:], objects):
+            yield value
+
+
+@contextlib.contextmanager
+def file_lock(path, wait=True, timeout=TOKEN_LOCK_TIMEOUT):
+    """Hold an advisory lock on ``path`` shared by all plugins on the host.
+
+    Yields whether the lock was obtained. With ``wait`` the lock is polled
+    for up to ``timeout`` seconds, after which the caller goes on unlocked
+    rather than failing the check.
+    """
+    try:
+        lock_file = open(path, 'a')
+    except IOError:
+        yield False
+        return
+
+    deadline = time.time() + timeout
+    locked = False
+    try:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+                break
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if not wait or time.time() >= deadline:
+                break
+            time.sleep(0.1)
+        yield locked
+    finally:
+        if locked:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def token_lock(wait=True, timeout=TOKEN_LOCK_TIMEOUT):
+    """Hold the lock under which the shared token is refreshed."""
+    return file_lock(TOKEN_LOCK_FILE, wait, timeout)
+
+
+def get_memcache_client(servers):
+    try:
+        import memcache
+    except ImportError:
+        status_err('Cannot import memcache')
+    return memcache.Client(servers)
+
+
+def get_cluster_snapshot(name, max_age, fetch, servers=None, path=None):
+    """Return cluster-wide data published by one check for all the others.
+
+    The data returned by ``fetch`` is published under ``name`` in memcached
+    when ``servers`` are given, or in the file ``path`` otherwise. A snapshot
+    is used while it is less than ``max_age`` seconds old. When it is stale,
+    the first check to take the publisher lock calls ``fetch`` and publishes
+    the result; the other checks get None and should query the API directly
+    for the little they need rather than wait. They get None as well when
+    there is nowhere to publish, since a snapshot only pays for its
+    unfiltered request when several checks share it.
+    """
+    def fresh(snapshot):
+        return (isinstance(snapshot, dict) and
+                snapshot.get('version') == SNAPSHOT_VERSION and
+                0 <= time.time() - snapshot.get('published_at', 0) < max_age)
+
+    def publish(data):
+        return {'version': SNAPSHOT_VERSION,
+                'published_at': time.time(),
+                'publisher': socket.gethostname(),
+                'data': data}
+
+    if servers:
+        client = get_memcache_client(servers)
+        key = 'maas_snapshot_%s' % name
+        snapshot = client.get(key)
+        if fresh(snapshot):
+            return snapshot['data']
+        if not client.add(key + '_lock', socket.gethostname(),
+                          time=SNAPSHOT_LOCK_TIMEOUT):
+            return None
+        try:
+            snapshot = publish(fetch())
+            client.set(key, snapshot, time=max_age * 2)
+        finally:
+            client.delete(key + '_lock')
+        return snapshot['data']
+
+    if not path:
+        return None
+    snapshot = read_json_file(path)
+    if fresh(snapshot):
+        return snapshot['data']
+    with file_lock(path + '.lock', wait=False) as locked:
+        if not locked:
+            return None
+        snapshot = read_json_file(path)
+        if not fresh(snapshot):
+            snapshot = publish(fetch())
+            try:
+                write_json_atomic(path, snapshot)
+            except (IOError, OSError) as e:
+                logging.warning('Could not publish the snapshot %s: %s',
+                                path, e)
+        return snapshot['data']
+
+
+def refresh_auth_ref(current=None, rejected=None):
+    """Replace the shared token, authenticating once for all plugins.
+
+    Only the holder of the token lock talks to keystone; plugins queued
+    behind it pick up the token it wrote. ``current`` is a token that is
+    close to expiry but still usable, in which case nobody waits for the
+    lock. ``rejected`` is a token the API refused, which must not be reused.
+    """
+    global AUTH_REF
+    with token_lock(wait=current is None) as locked:
+        if not locked and current is not None:
+            # someone else is already refreshing
+            return current
+
+        auth_ref = get_auth_from_file()
+        if (auth_ref is not None and
+                not is_token_expired(auth_ref, TOKEN_REFRESH_MARGIN) and
+                (rejected is None or
+                 auth_ref['auth_token'] != rejected['auth_token'])):
+            AUTH_REF = auth_ref
+            return auth_ref
+
+        return keystone_auth(get_auth_details())
+
+
+@profiled('auth')
 def get_auth_ref():
-    auth_details = get_auth_details()
-    auth_ref = get_auth_from_file()
-    if auth_ref is None:
-        auth_ref = keystone_auth(auth_details)
+    global AUTH_REF
+    if (AUTH_REF is not None and
+            not is_token_expired(AUTH_REF, TOKEN_REFRESH_MARGIN)):
+        return AUTH_REF
 
-    if is_token_expired(auth_ref):
-        auth_ref = keystone_auth(auth_details)
+    auth_ref = get_auth_from_file()
+    if auth_ref is None or is_token_expired(auth_ref):
+        auth_ref = refresh_auth_ref()
+    elif is_token_expired(auth_ref, TOKEN_REFRESH_MARGIN):
+        auth_ref = refresh_auth_ref(current=auth_ref)
 
+    AUTH_REF = auth_ref
     return auth_ref
 
 
 def get_auth_from_file():
+    global CATALOG_INDEX
     try:
         with open(TOKEN_FILE) as token_file:
             auth_ref = json.load(token_file)
 
+        index = auth_ref.pop('maas_catalog_index', None)
+        if index is not None:
+            CATALOG_INDEX = (get_service_catalog(auth_ref), index)
         return auth_ref
+    except ValueError:
+        # a corrupt token file is simply replaced
+        return None
     except IOError as e:
         if e.errno == errno.ENOENT:
             return None
@@ -377,6 +761,7 @@ def get_auth_from_file():
 
 def get_auth_details(openrc_file=OPENRC):
     auth_details = AUTH_DETAILS
+    optional = OPTIONAL_AUTH_DETAILS
     pattern = re.compile(
         '^(?:export\s)?(?P<key>\w+)(?:\s+)?=(?:\s+)?(?P<value>.*)$'
     )
@@ -391,12 +776,16 @@ def get_auth_details(openrc_file=OPENRC):
                 v = match.group('value')
                 if k in auth_details and auth_details[k] is None:
                     auth_details[k] = v
+                elif k in optional and optional[k] is None:
+                    optional[k] = v
     except IOError as e:
         if e.errno != errno.ENOENT:
             status_err(e)
         # no openrc file, so we try the environment
         for key in auth_details.keys():
             auth_details[key] = os.environ.get(key)
+        for key in optional.keys():
+            optional[key] = os.environ.get(key)
 
     for key in auth_details.keys():
         if auth_details[key] is None:
@@ -405,27 +794,82 @@ def get_auth_details(openrc_file=OPENRC):
     return auth_details
 
 
+def get_region():
+    """Return OS_REGION_NAME from the openrc file or environment, if set."""
+    get_auth_details()
+    return OPTIONAL_AUTH_DETAILS['OS_REGION_NAME']
+
+
+def get_service_catalog(auth_ref):
+    """Return the service catalog of a keystone v2 or v3 auth_ref."""
+    if 'catalog' in auth_ref:
+        return auth_ref['catalog']
+    return auth_ref.get('serviceCatalog', [])
+
+
+def get_project_id(auth_ref):
+    """Return the project (tenant) id of a keystone v2 or v3 auth_ref."""
+    if 'project' in auth_ref:
+        return auth_ref['project']['id']
+    return auth_ref['token']['tenant']['id']
+
+
+def catalog_index(service_catalog):
+    """Index a v2 or v3 service catalog by type, interface and region.
+
+    ::
+
+        >>> catalog_index(auth_ref['catalog'])
+        {'compute': {'public': {'RegionOne': ['http://.../v2/<tenant>']}}}
+
+    Endpoints without a region are filed under ''.
+    """
+    index = {}
+    for service in service_catalog:
+        by_interface = index.setdefault(service['type'], {})
+        for endpoint in service['endpoints']:
+            region = endpoint.get('region') or endpoint.get('region_id') or ''
+            if 'interface' in endpoint:
+                urls = [(endpoint['interface'], endpoint['url'])]
+            else:
+                urls = [(interface, endpoint[key])
+                        for key, interface in V2_INTERFACES.items()
+                        if key in endpoint]
+            for interface, url in urls:
+                by_region = by_interface.setdefault(interface, {})
+                by_region.setdefault(region, []).append(url)
+    return index
+
+
 def get_endpoint_url_for_service(service_type, service_catalog,
-                                 url_type='public', version=None):
+                                 url_type='public', version=None,
+                                 region=None):
     # version = the version identifier on the end of the url. eg:
     # for keystone admin api v3:
     # http://172.29.236.3:35357/v3
     # so you'd pass version='v3'
+    # region = only consider endpoints in this region, any region if None
+    global CATALOG_INDEX
+    catalog, index = CATALOG_INDEX
+    if catalog is not service_catalog:
+        index = catalog_index(service_catalog)
+        CATALOG_INDEX = (service_catalog, index)
+
+    by_region = index.get(service_type, {}).get(url_type, {})
+    if region:
+        urls = by_region.get(region, [])
+    else:
+        urls = [url for region_urls in by_region.values()
+                for url in region_urls]
 
-    for service in service_catalog:
-        if service['type'] == service_type:
-            for endpoint in service['endpoints']:
-                if endpoint['interface'] == url_type:
-                    if version:
-                        if endpoint['url'].endswith(version):
-                            return endpoint['url']
-                    else:
-                        return endpoint['url']
+    for url in urls:
+        if not version or url.endswith(version):
+            return url
 
 
+@profiled('auth')
 def force_reauth():
-    auth_details = get_auth_details()
-    return keystone_auth(auth_details)
+    return refresh_auth_ref(rejected=AUTH_REF)
 
 
 STATUS = ''
@@ -460,18 +904,240 @@ def status_ok(message=None, force_print=False):
     status('okay', message, force_print=force_print)
 
 
+Metric = collections.namedtuple('Metric', ['name', 'type', 'value', 'unit',
+                                           'family'])
 METRICS = []
+MAX_METRICS = 30
+# How print_output renders the check, see OUTPUT_FORMATS.
+OUTPUT_FORMAT = os.environ.get('MAAS_OUTPUT_FORMAT', 'legacy')
+# What happens to the metrics beyond MAX_METRICS in the legacy format:
+# error fails the check as soon as one too many is gathered, split prints
+# the first MAX_METRICS and leaves the rest in the spool for
+# metrics_spool.py, summary rolls families of metrics up into statistics.
+METRIC_OVERFLOW = os.environ.get('MAAS_METRIC_OVERFLOW', 'error')
+SPOOL_DIR = os.environ.get('MAAS_SPOOL_DIR', '/root/.maas_spool')
+INT_METRIC_TYPES = ('int32', 'uint32', 'int64', 'uint64')
+
+
+def metric(name, metric_type, value, unit=None, family=None):
+    """Gather a metric for print_output.
+
+    ``family`` groups metrics which the summary overflow mode may roll up
+    together; it defaults to the name with every number replaced by N, so
+    that e.g. osd.1_up and osd.2_up belong to osd.N_up.
+    """
+    global METRICS
+    if (OUTPUT_FORMAT == 'legacy' and METRIC_OVERFLOW == 'error' and
+            len(METRICS) >= MAX_METRICS):
+        status_err('Maximum of %d metrics per check' % MAX_METRICS)
+    if family is None:
+        family = re.sub(r'\d+', 'N', name)
+    METRICS.append(Metric(name, metric_type, value, unit, family))
 
 
-def metric(name, metric_type, value, unit=None):
-    global METRICS
-    if len(METRICS) > 29:
-        status_err('Maximum of 30 metrics per check')
-    metric_line = 'metric %s %s %s' % (name, metric_type, value)
-    if unit is not None:
-        metric_line = ' '.join((metric_line, unit))
-    metric_line = metric_line.replace('\n', '\\n')
-    METRICS.append(metric_line)
+def reset_output():
+    """Forget the status and metrics gathered by a previous check."""
+    global STATUS, METRICS
+    STATUS = ''
+    METRICS = []
+
+
+def typed_value(m):
+    """Return the value of metric ``m`` as the Python type it stands for."""
+    try:
+        if m.type in INT_METRIC_TYPES:
+            return int(m.value)
+        if m.type in ('double', 'float'):
+            return float(m.value)
+    except (TypeError, ValueError):
+        pass
+    return m.value
+
+
+def summarise_metrics(metrics, limit=MAX_METRICS):
+    """Roll families of metrics up into count, min, max and avg metrics.
+
+    Metrics alone in their family are kept as they are. Whatever still does
+    not fit within ``limit`` is dropped and counted in metrics_dropped.
+    """
+    if len(metrics) <= limit:
+        return metrics
+    families = collections.OrderedDict()
+    for m in metrics:
+        families.setdefault((m.family, m.unit), []).append(m)
+
+    summary = []
+    for (family, unit), members in families.items():
+        if len(members) == 1:
+            summary.extend(members)
+            continue
+        summary.append(Metric('%s_count' % family, 'uint32', len(members),
+                              None, family))
+        values = [typed_value(m) for m in members]
+        if all(isinstance(v, (int, long, float)) for v in values):
+            metric_type = members[0].type
+            summary.extend([
+                Metric('%s_min' % family, metric_type, min(values), unit,
+                       family),
+                Metric('%s_max' % family, metric_type, max(values), unit,
+                       family),
+                Metric('%s_avg' % family, 'double',
+                       '%.3f' % (sum(values) / float(len(values))), unit,
+                       family)])
+
+    if len(summary) > limit:
+        dropped = len(summary) - limit + 1
+        summary = summary[:limit - 1] + [
+            Metric('metrics_dropped', 'uint32', dropped, 'metrics',
+                   'metrics_dropped')]
+    return summary
+
+
+def spool_path(argv):
+    """Return the spool file of the check run with ``argv``."""
+    plugin = os.path.splitext(os.path.basename(argv[0]))[0]
+    digest = hashlib.sha1(json.dumps(argv[1:])).hexdigest()[:12]
+    return os.path.join(SPOOL_DIR, '%s-%s.json' % (plugin, digest))
+
+
+def split_metrics(metrics, argv, limit=MAX_METRICS):
+    """Return the metrics to print now, spooling the rest in chunks.
+
+    The first chunk, printed by the check itself, ends with metric_chunks,
+    the total number of chunks. metrics_spool.py prints the others. Nothing
+    is spooled when the metrics fit, and what a previous run spooled is
+    removed. When the spool cannot be written the check fails as with the
+    error overflow, though the first ``limit`` metrics are still printed.
+    """
+    path = spool_path(argv)
+    if len(metrics) <= limit:
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning('Could not remove the spool %s: %s', path, e)
+        return metrics
+
+    rest = metrics[limit - 1:]
+    chunks = [rest[i:i + limit] for i in range(0, len(rest), limit)]
+    try:
+        if not os.path.isdir(SPOOL_DIR):
+            os.makedirs(SPOOL_DIR)
+        write_json_atomic(path, {'written_at': time.time(),
+                                 'status': STATUS,
+                                 'chunks': chunks})
+    except (IOError, OSError) as e:
+        status('error', 'Maximum of %d metrics per check, the rest cannot be '
+                        'spooled: %s' % (limit, e))
+        return metrics[:limit]
+    return metrics[:limit - 1] + [
+        Metric('metric_chunks', 'uint32', len(chunks) + 1, 'chunks',
+               'metric_chunks')]
+
+
+def format_legacy(status_line, metrics):
+    lines = [status_line] if status_line else []
+    for m in metrics:
+        metric_line = 'metric %s %s %s' % (m.name, m.type, m.value)
+        if m.unit is not None:
+            metric_line = ' '.join((metric_line, m.unit))
+        lines.append(metric_line.replace('\n', '\\n'))
+    return '\n'.join(lines)
+
+
+def parse_status(status_line):
+    """Split a status line into its state and message."""
+    _, state, message = (status_line.split(' ', 2) + ['', '', ''])[:3]
+    return state, message.replace('\\n', '\n') or None
+
+
+def format_json(status_line, metrics):
+    state, message = parse_status(status_line)
+    return json.dumps({'status': state,
+                       'message': message,
+                       'metrics': [{'name': m.name,
+                                    'type': m.type,
+                                    'value': typed_value(m),
+                                    'unit': m.unit} for m in metrics]})
+
+
+def openmetrics_labels(labels):
+    def escape(value):
+        return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v))
+                             for k, v in sorted(labels.items()))
+
+
+def openmetrics_value(value):
+    """Format a number as OpenMetrics expects it.
+
+    repr() would give 123L for a long and nan or inf for the non-finite
+    floats, none of which OpenMetrics accepts.
+    """
+    if isinstance(value, (int, long)):
+        return '%d' % value
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def openmetrics_samples(state, message, metrics, labels=None):
+    """Yield (family, type, sample) for a check's status and metrics.
+
+    Metric names get a maas_ prefix, with any character OpenMetrics does not
+    allow replaced by an underscore. Numeric metrics become gauges carrying
+    their unit as a label; string metrics become info metrics carrying their
+    value as a label.
+    """
+    labels = labels or {}
+    yield ('maas_check_up', 'gauge', 'maas_check_up%s %d' %
+           (openmetrics_labels(labels), state == 'okay'))
+    if message:
+        yield ('maas_check_message', 'info', 'maas_check_message_info%s 1' %
+               openmetrics_labels(dict(labels, message=message[:250])))
+    for m in metrics:
+        family = 'maas_%s' % re.sub(r'[^a-zA-Z0-9_]', '_', m.name)
+        value = typed_value(m)
+        if isinstance(value, (int, long, float)):
+            sample_labels = dict(labels)
+            if m.unit:
+                sample_labels['unit'] = m.unit
+            yield (family, 'gauge', '%s%s %s' %
+                   (family, openmetrics_labels(sample_labels),
+                    openmetrics_value(value)))
+        else:
+            yield (family, 'info', '%s_info%s 1' %
+                   (family, openmetrics_labels(dict(labels, value=value))))
+
+
+def render_openmetrics(samples):
+    """Render samples from one or more checks as an OpenMetrics document."""
+    families = collections.OrderedDict()
+    for family, metric_type, sample in samples:
+        families.setdefault((family, metric_type), collections.OrderedDict())
+        families[(family, metric_type)][sample.rsplit(' ', 1)[0]] = sample
+    lines = []
+    for (family, metric_type), family_samples in families.items():
+        lines.append('# TYPE %s %s' % (family, metric_type))
+        lines.extend(family_samples.values())
+    lines.append('# EOF')
+    return '\n'.join(lines)
+
+
+def format_openmetrics(status_line, metrics):
+    state, message = parse_status(status_line)
+    return render_openmetrics(openmetrics_samples(state, message, metrics))
+
+
+OUTPUT_FORMATS = {'legacy': format_legacy,
+                  'json': format_json,
+                  'openmetrics': format_openmetrics}
 
 
 def metric_bool(name, success):
@@ -479,24 +1145,313 @@ def metric_bool(name, success):
     metric(name, 'uint32', value)
 
 
+SERVICE_STATES = ('up', 'down', 'disabled')
+
+
+def report_service_states(services, state_file):
+    """Report service counts plus the services that changed state.
+
+    ``services`` maps each service's metric name to (binary, state), where
+    state is one of SERVICE_STATES. The number of services in each state is
+    reported for every binary; the individual status metrics are only
+    reported for services whose state differs from the one recorded in
+    ``state_file`` by the previous run, down services first. All of these
+    share the metric limit: the number of changes comes first, then the
+    counts of down, up and disabled services of every binary, then the
+    changes. Changes left out are reported by the next run.
+    """
+    budget = max(MAX_METRICS - len(METRICS), 0)
+    counts = {}
+    for binary, state in services.values():
+        counts.setdefault(binary, dict.fromkeys(SERVICE_STATES, 0))
+        counts[binary][state] += 1
+
+    previous = read_json_file(state_file) or {}
+    changed = sorted((state != 'down', name)
+                     for name, (_, state) in services.items()
+                     if previous.get(name) != state)
+    count_metrics = [('service_state_changes', len(changed))]
+    for state in ('down', 'up', 'disabled'):
+        count_metrics.extend(('%s_%s' % (binary, state), counts[binary][state])
+                             for binary in sorted(counts))
+    for name, value in count_metrics[:budget]:
+        metric(name, 'uint32', value, 'services')
+    budget -= len(count_metrics[:budget])
+
+    recorded = dict((name, previous[name]) for name in services
+                    if name in previous)
+    for _, name in changed[:budget]:
+        state = services[name][1]
+        metric_bool(name, state != 'down')
+        recorded[name] = state
+    try:
+        write_json_atomic(state_file, recorded)
+    except (IOError, OSError) as e:
+        status_err('Cannot record the service states in %s: %s' %
+                   (state_file, e))
+
+
+HISTORY_DIR = os.environ.get('MAAS_HISTORY_DIR', '/root/.maas_history')
+# samples kept in each history; rates are averaged over all of them
+HISTORY_SAMPLES = 5
+
+
+def history_path(*key):
+    """Return the history file of the counters identified by ``key``.
+
+    ::
+
+        >>> history_path('galera_check', '172.29.236.100', 3306)
+        '/root/.maas_history/galera_check-172.29.236.100-3306.json'
+    """
+    name = '-'.join(re.sub(r'[^\w.]+', '_', str(part)) for part in key)
+    return os.path.join(HISTORY_DIR, '%s.json' % name)
+
+
+def record_sample(path, counters, keep=HISTORY_SAMPLES):
+    """Add ``counters`` to the history stored at ``path`` and return it.
+
+    The history is a list of {'time': ..., 'counters': {...}} samples,
+    oldest first, of which the last ``keep`` are stored. When the history
+    cannot be read or written only the new sample is returned, so that no
+    rate is computed by this run rather than the check failing.
+    """
+    sample = {'time': time.time(), 'counters': counters}
+    try:
+        history = read_json_file(path) or []
+        history.append(sample)
+        history = history[-keep:]
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_json_atomic(path, history)
+    except (IOError, OSError) as e:
+        logging.warning('Could not record the history %s: %s', path, e)
+        return [sample]
+    return history
+
+
+def counter_increases(history, window=None, uptime=None):
+    """Return ({counter: increase}, seconds) over the samples of ``history``.
+
+    When ``window`` is given only the samples of the last ``window`` seconds
+    are used. A counter which went down was reset, e.g. by a restart, so its
+    new value is taken as the increase since the reset. Counters may grow
+    back past their old value before the next sample, so when the counter
+    named ``uptime`` went down every counter is taken as reset. Counters
+    missing from the newest sample, or never sampled twice, are left out.
+    """
+    if window is not None:
+        since = history[-1]['time'] - window
+        history = [sample for sample in history if sample['time'] >= since]
+    if len(history) < 2:
+        return {}, 0.0
+
+    increases = {}
+    for previous, current in zip(history, history[1:]):
+        restarted = (uptime in previous['counters'] and
+                     uptime in current['counters'] and
+                     current['counters'][uptime] <
+                     previous['counters'][uptime])
+        for name in history[-1]['counters']:
+            if (name not in previous['counters'] or
+                    name not in current['counters']):
+                continue
+            value, last = current['counters'][name], previous['counters'][name]
+            if restarted or value < last:
+                last = 0
+            increases[name] = increases.get(name, 0) + value - last
+    return increases, history[-1]['time'] - history[0]['time']
+
+
+def counter_rates(history, window=None, uptime=None):
+    """Return {counter: increase per second} over the samples of ``history``.
+
+    No rates are returned until the history holds two samples.
+    """
+    increases, elapsed = counter_increases(history, window, uptime)
+    if elapsed <= 0:
+        return {}
+    return dict((name, float(increase) / elapsed)
+                for name, increase in increases.items())
+
+
+def parse_node(spec, default_port=None):
+    """Turn HOST[:PORT] into (host, port).
+
+    The port is an int, or None when neither ``spec`` nor ``default_port``
+    gives one.
+    """
+    host, _, port = spec.strip().partition(':')
+    port = port or default_port
+    return host, int(port) if port is not None else None
+
+
+def fan_out(func, items, workers=None, errors=Exception):
+    """Return [func(item) for item in items], calling func in threads.
+
+    At most ``workers`` items, all of them by default, are handled at once.
+    An exception of ``errors`` raised for an item is returned in its place
+    rather than raised: the main thread has to report it, since status_err
+    cannot exit from a pool thread.
+    """
+    from multiprocessing import pool
+
+    def call(item):
+        try:
+            return func(item)
+        except errors as e:
+            return e
+
+    items = list(items)
+    if not items:
+        return []
+    threads = pool.ThreadPool(min(workers or len(items), len(items)))
+    try:
+        return threads.map(call, items)
+    finally:
+        threads.close()
+
+
+def count_resources():
+    """Count the subprocesses started and the bytes received over HTTP."""
+    if getattr(subprocess.Popen, 'maas_counted', False):
+        return
+    popen_init = subprocess.Popen.__init__
+
+    def counted_init(self, *args, **kwargs):
+        with PROFILE_LOCK:
+            COUNTERS['subprocesses'] += 1
+        popen_init(self, *args, **kwargs)
+
+    subprocess.Popen.__init__ = counted_init
+    subprocess.Popen.maas_counted = True
+
+    try:
+        import requests
+    except ImportError:
+        return
+    send = requests.Session.send
+
+    def counted_send(self, request, **kwargs):
+        response = send(self, request, **kwargs)
+        if kwargs.get('stream'):
+            # leave streamed bodies unread
+            received = int(response.headers.get('content-length') or 0)
+        else:
+            received = len(response.content)
+        with PROFILE_LOCK:
+            COUNTERS['bytes_received'] += received
+        return response
+
+    requests.Session.send = counted_send
+
+
+def reset_profile():
+    PHASES.clear()
+    for counter in COUNTERS:
+        COUNTERS[counter] = 0
+
+
+def get_profile(elapsed):
+    """Return the profile of a check run which took ``elapsed`` seconds."""
+    phases = dict((name, seconds * 1000) for name, seconds in PHASES.items())
+    phases['other'] = max(elapsed - sum(PHASES.values()), 0) * 1000
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {'total_ms': elapsed * 1000,
+            'phases_ms': phases,
+            'subprocesses': COUNTERS['subprocesses'],
+            'bytes_received': COUNTERS['bytes_received'],
+            'peak_rss_kb': peak_rss}
+
+
+def profile_metrics(profile):
+    yield Metric('plugin_time_total', 'double',
+                 '%.3f' % profile['total_ms'], 'ms', 'plugin_time')
+    for name, ms in sorted(profile['phases_ms'].items()):
+        yield Metric('plugin_time_%s' % name, 'double', '%.3f' % ms, 'ms',
+                     'plugin_time')
+    yield Metric('plugin_subprocesses', 'uint32', profile['subprocesses'],
+                 'processes', 'plugin_subprocesses')
+    yield Metric('plugin_bytes_received', 'uint64',
+                 profile['bytes_received'], 'bytes', 'plugin_bytes_received')
+    yield Metric('plugin_peak_rss', 'uint64', profile['peak_rss_kb'], 'KB',
+                 'plugin_peak_rss')
+
+
+def log_profile(profile):
+    """Append the profile of the check as a line of JSON to the log."""
+    state, message = parse_status(STATUS)
+    record = dict(profile,
+                  time=datetime.datetime.utcnow().isoformat(),
+                  plugin=os.path.basename(sys.argv[0]),
+                  args=sys.argv[1:],
+                  status=state,
+                  metrics=len(METRICS))
+    try:
+        with open(PROFILE_LOG_FILE, 'a') as log:
+            log.write(json.dumps(record) + '\n')
+    except IOError:
+        logging.warning('Could not write the profile of %s', sys.argv[0])
+
+
 logging.basicConfig(filename='/var/log/maas_plugins.log',
                     format='%(asctime)s %(levelname)s: %(message)s')
 
 
 @contextlib.contextmanager
-def print_output():
+def print_output(output_format=None, overflow=None, profile=None):
+    """Print the status and metrics gathered by the check.
+
+    ``output_format``, ``overflow`` and ``profile`` default to
+    MAAS_OUTPUT_FORMAT, MAAS_METRIC_OVERFLOW and MAAS_PROFILE from the
+    environment, see OUTPUT_FORMAT, METRIC_OVERFLOW and PROFILE_OUTPUT.
+    """
+    global OUTPUT_FORMAT, METRIC_OVERFLOW, PROFILE_OUTPUT
+    OUTPUT_FORMAT = (output_format or
+                     os.environ.get('MAAS_OUTPUT_FORMAT', 'legacy'))
+    METRIC_OVERFLOW = (overflow or
+                       os.environ.get('MAAS_METRIC_OVERFLOW', 'error'))
+    PROFILE_OUTPUT = (profile if profile is not None else
+                      os.environ.get('MAAS_PROFILE', ''))
+    if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format %s' % OUTPUT_FORMAT)
+    formatter = OUTPUT_FORMATS[OUTPUT_FORMAT]
+    profile_output = set(PROFILE_OUTPUT.split(',')) - set([''])
+    if profile_output:
+        count_resources()
+    reset_profile()
+    start = time.time()
     try:
         yield
     except SystemExit as e:
         if STATUS:
-            print(STATUS)
+            print(formatter(STATUS, []))
         raise
     except Exception as e:
         logging.exception('The plugin %s has failed with an unhandled '
                           'exception', sys.argv[0])
-        status_err(traceback.format_exc(), force_print=True, exception=e)
+        # a status message cannot exceed 256 characters
+        # 'error ' plus up to 250 from the end of the exception
+        status('error', traceback.format_exc()[-250:])
+        print(formatter(STATUS, []))
+        raise
     else:
-        if STATUS:
-            print(STATUS)
-        for metric in METRICS:
-            print(metric)
+        metrics = METRICS
+        if 'metrics' in profile_output:
+            extra = list(profile_metrics(get_profile(time.time() - start)))
+            # profiling must not be what makes the check fail
+            if (OUTPUT_FORMAT != 'legacy' or METRIC_OVERFLOW != 'error' or
+                    len(metrics) + len(extra) <= MAX_METRICS):
+                metrics = metrics + extra
+        if OUTPUT_FORMAT == 'legacy' and METRIC_OVERFLOW == 'split':
+            metrics = split_metrics(metrics, sys.argv)
+        elif OUTPUT_FORMAT == 'legacy' and METRIC_OVERFLOW == 'summary':
+            metrics = summarise_metrics(metrics)
+        output = formatter(STATUS, metrics)
+        if output:
+            print(output)
+    finally:
+        if 'log' in profile_output:
+            log_profile(get_profile(time.time() - start))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# Copyright 2015, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serve the metrics of a set of plugins to Prometheus.
+
+The plugins listed in the configuration file are run in-process on a
+schedule, the same way maasd.py runs them, and the latest result of every
+check is served in OpenMetrics text format on /metrics::
+
+    {"interval": 60,
+     "checks": [{"name": "nova_api",
+                 "plugin": "nova_api_local_check.py",
+                 "args": ["172.29.236.100"]},
+                {"name": "rabbitmq",
+                 "plugin": "rabbitmq_status.py",
+                 "args": ["-H", "172.29.236.101"],
+                 "interval": 30}]}
+
+Every sample is labelled with the name of its check.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import SocketServer
+import threading
+import time
+
+import maas_common
+import maasd
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+class Scheduler(threading.Thread):
+    """Run each check every interval and keep its latest result."""
+
+    def __init__(self, checks, interval):
+        super(Scheduler, self).__init__()
+        self.daemon = True
+        self.runner = maasd.make_runner()
+        self.checks = checks
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def run_check(self, check):
+        start = time.time()
+        try:
+            _, output, _ = self.runner.run(check['plugin'],
+                                           check.get('args', []),
+                                           output_format='json')
+        except (ValueError, OSError, IOError) as e:
+            # the plugin could not be loaded
+            output = json.dumps({'status': 'error', 'message': str(e),
+                                 'metrics': []})
+        duration = time.time() - start
+        try:
+            result = json.loads(output)
+            metrics = [maas_common.Metric(m['name'], m['type'], m['value'],
+                                          m['unit'], None)
+                       for m in result['metrics']]
+            state, message = result['status'], result['message']
+        except (ValueError, KeyError, TypeError):
+            # the plugin failed before print_output could render it
+            metrics, state, message = [], 'error', output.strip()
+        with self.lock:
+            self.results[check['name']] = (start, duration, state, message,
+                                           metrics)
+
+    def run(self):
+        due = dict((check['name'], 0) for check in self.checks)
+        while True:
+            for check in self.checks:
+                if due[check['name']] <= time.time():
+                    try:
+                        self.run_check(check)
+                    except Exception:
+                        logging.exception('maas_exporter failed to run %s',
+                                          check['name'])
+                    due[check['name']] = time.time() + check.get(
+                        'interval', self.interval)
+            time.sleep(max(min(due.values()) - time.time(), 0.5))
+
+    def samples(self):
+        with self.lock:
+            results = sorted(self.results.items())
+        for name, (start, duration, state, message, metrics) in results:
+            labels = {'check': name}
+            yield ('maas_check_last_run_timestamp_seconds', 'gauge',
+                   'maas_check_last_run_timestamp_seconds%s %.3f' %
+                   (maas_common.openmetrics_labels(labels), start))
+            yield ('maas_check_duration_seconds', 'gauge',
+                   'maas_check_duration_seconds%s %.3f' %
+                   (maas_common.openmetrics_labels(labels), duration))
+            for sample in maas_common.openmetrics_samples(state, message,
+                                                          metrics, labels):
+                yield sample
+
+
+def make_handler(scheduler):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = maas_common.render_openmetrics(
+                scheduler.samples()).encode('utf-8') + '\n'
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve plugin metrics in OpenMetrics format')
+    parser.add_argument('config',
+                        help='JSON file listing the checks to run')
+    parser.add_argument('--listen',
+                        default='127.0.0.1',
+                        help='Address to serve /metrics on')
+    parser.add_argument('--port',
+                        type=int,
+                        default=9779,
+                        help='Port to serve /metrics on')
+    parser.add_argument('--interval',
+                        type=int,
+                        help='Seconds between runs of checks which do not '
+                             'set their own interval')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    scheduler = Scheduler(config['checks'],
+                          args.interval or config.get('interval', 60))
+    scheduler.start()
+    Server((args.listen, args.port), make_handler(scheduler)).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+# Copyright 2015, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run MaaS plugins inside one long-lived process.
+
+``maasd.py --serve`` starts the daemon. It listens on a Unix socket and runs
+plugins from its own directory in-process, so the OpenStack client libraries,
+maas_common's clients and the parsed auth_ref are only loaded once.
+
+Any other invocation is the shim the agent calls instead of the plugin::
+
+    maasd.py nova_api_local_check.py 172.29.236.100
+
+The shim hands the plugin name and arguments to the daemon and prints the
+plugin's output and errors verbatim. When the daemon is not running, the
+shim executes the plugin directly, exactly as the agent would have. Once the
+plugin was handed over it is never run again by the shim, since the daemon
+may have run it already; a daemon which does not answer is reported as an
+error instead.
+
+Each request gets RUN_TIMEOUT seconds in the daemon, the wait for earlier
+runs included. A plugin still running then is interrupted and reported as an
+error, and a request whose time is up, or whose shim has gone, is dropped
+without being run.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import socket
+import sys
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+SOCKET_PATH = os.environ.get('MAASD_SOCKET', '/var/run/maasd.sock')
+SHIM_TIMEOUT = 60
+# the daemon gives up on a plugin before the shim gives up on the daemon
+RUN_TIMEOUT = SHIM_TIMEOUT - 10
+
+
+class NotServing(Exception):
+    """The daemon could not be given the plugin to run."""
+
+
+class RunTimeout(BaseException):
+    """Raised inside a plugin which has run for too long.
+
+    It is not an Exception so that the plugins' own handlers let it through.
+    """
+
+
+def request(plugin, args, socket_path=SOCKET_PATH, timeout=SHIM_TIMEOUT):
+    """Ask the daemon to run ``plugin``; return (returncode, output, errors).
+
+    NotServing is raised when the daemon cannot have run the plugin.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(socket_path)
+            # the daemon ignores a request which is not a whole line
+            sock.sendall(json.dumps({'plugin': plugin, 'args': args}) + '\n')
+        except socket.error as e:
+            raise NotServing(str(e))
+        response = sock.makefile('r').readline()
+    finally:
+        sock.close()
+    if not response:
+        raise socket.error('maasd closed the connection without a response')
+    response = json.loads(response)
+    return (response['returncode'], response['output'],
+            response.get('errors', ''))
+
+
+def shim(argv):
+    plugin, args = os.path.basename(argv[0]), argv[1:]
+    try:
+        returncode, output, errors = request(plugin, args)
+    except NotServing:
+        # No daemon to talk to; behave exactly like the plain plugin would.
+        path = os.path.join(PLUGIN_DIR, plugin)
+        os.execv(sys.executable, [sys.executable, path] + args)
+    except (socket.error, ValueError, KeyError) as e:
+        # The plugin may have run, running it again would repeat its side
+        # effects.
+        print('status error maasd did not answer for %s: %s' % (plugin, e))
+        return 1
+    sys.stderr.write(errors)
+    sys.stderr.flush()
+    sys.stdout.write(output)
+    sys.stdout.flush()
+    return returncode
+
+
+def make_runner(plugin_dir=PLUGIN_DIR, timeout=RUN_TIMEOUT):
+    """Return a PluginRunner for the plugins in ``plugin_dir``.
+
+    A plugin is interrupted once it runs for more than ``timeout`` seconds.
+    """
+    # Only the daemon pays for these imports; the shim must stay cheap.
+    import ctypes
+    import logging
+    import StringIO
+    import threading
+    import time
+    import traceback
+
+    import maas_common
+
+    class PluginRunner(object):
+        """Compile each plugin once and execute it on demand.
+
+        Plugins keep their state in maas_common's module globals and write
+        to sys.stdout, so runs are serialised.
+        """
+
+        def __init__(self, plugin_dir, timeout):
+            self.plugin_dir = plugin_dir
+            self.timeout = timeout
+            self.lock = threading.Lock()
+            self.code = {}
+
+        def interrupt(self, plugin, timeout, thread_id, running):
+            # RunTimeout is raised in the plugin's thread at its next Python
+            # instruction, a blocking call is only interrupted once it returns
+            with running['lock']:
+                if not running['value']:
+                    return
+                logging.error('maasd gave up on %s after %ds', plugin,
+                              round(timeout))
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ctypes.c_long(thread_id), ctypes.py_object(RunTimeout))
+
+        def execute(self, code, path, running):
+            try:
+                exec(code, {'__name__': '__main__', '__file__': path})
+            finally:
+                # a RunTimeout raised too late to interrupt the plugin is
+                # discarded rather than left to hit whatever runs next
+                with running['lock']:
+                    running['value'] = False
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                        ctypes.c_long(threading.current_thread().ident),
+                        None)
+
+        def acquire(self, deadline, gone):
+            """Wait for the earlier runs; False once the wait is pointless."""
+            while not self.lock.acquire(False):
+                if ((deadline is not None and time.time() >= deadline) or
+                        (gone is not None and gone())):
+                    return False
+                time.sleep(0.05)
+            return True
+
+        def load(self, plugin):
+            path = os.path.join(self.plugin_dir, plugin)
+            if (os.path.dirname(os.path.abspath(path)) != self.plugin_dir or
+                    not plugin.endswith('.py')):
+                raise ValueError('%s is not a plugin' % plugin)
+            mtime = os.stat(path).st_mtime
+            cached = self.code.get(path)
+            if cached is None or cached[0] != mtime:
+                with open(path) as f:
+                    cached = (mtime, compile(f.read(), path, 'exec'))
+                self.code[path] = cached
+            return path, cached[1]
+
+        def run(self, plugin, args, output_format=None, deadline=None,
+                gone=None):
+            """Run ``plugin``; return its exit code, output and errors.
+
+            The output and errors are what it would have written to stdout
+            and stderr. ``output_format`` overrides MAAS_OUTPUT_FORMAT for
+            this run. The plugin is not run once ``deadline`` has passed or
+            ``gone()`` is true, and it is interrupted at ``deadline``.
+            """
+            if not self.acquire(deadline, gone):
+                return (1, 'status error maasd could not run %s in time\n' %
+                        plugin, '')
+            try:
+                path, code = self.load(plugin)
+                output = StringIO.StringIO()
+                errors = StringIO.StringIO()
+                saved = sys.argv, sys.stdout, sys.stderr
+                saved_format = os.environ.get('MAAS_OUTPUT_FORMAT')
+                returncode = 0
+                timeout = self.timeout
+                if deadline is not None:
+                    timeout = min(timeout, deadline - time.time())
+                running = {'lock': threading.Lock(), 'value': True}
+                watchdog = threading.Timer(
+                    timeout, self.interrupt,
+                    [plugin, timeout, threading.current_thread().ident,
+                     running])
+                watchdog.daemon = True
+                try:
+                    maas_common.reset_output()
+                    if output_format:
+                        os.environ['MAAS_OUTPUT_FORMAT'] = output_format
+                    sys.argv = [path] + list(args)
+                    sys.stdout, sys.stderr = output, errors
+                    watchdog.start()
+                    self.execute(code, path, running)
+                except RunTimeout:
+                    output.write('status error maasd gave up on %s after '
+                                 '%ds\n' % (plugin, round(timeout)))
+                    returncode = 1
+                except SystemExit as e:
+                    if e.code is None:
+                        returncode = 0
+                    elif isinstance(e.code, int):
+                        returncode = e.code
+                    else:
+                        errors.write('%s\n' % e.code)
+                        returncode = 1
+                except Exception:
+                    logging.exception('maasd failed to run %s', plugin)
+                    errors.write(traceback.format_exc())
+                    # print_output has already printed the error status
+                    if not output.getvalue():
+                        output.write('status error %s\n' %
+                                     traceback.format_exc()[-250:].replace(
+                                         '\n', '\\n'))
+                    returncode = 1
+                finally:
+                    watchdog.cancel()
+                    sys.argv, sys.stdout, sys.stderr = saved
+                    if saved_format is None:
+                        os.environ.pop('MAAS_OUTPUT_FORMAT', None)
+                    else:
+                        os.environ['MAAS_OUTPUT_FORMAT'] = saved_format
+                return returncode, output.getvalue(), errors.getvalue()
+            finally:
+                self.lock.release()
+
+    return PluginRunner(plugin_dir, timeout)
+
+
+def serve(socket_path):
+    import select
+    import SocketServer
+    import time
+
+    runner = make_runner()
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def gone(self):
+            # the shim sends nothing after its request, so the socket only
+            # becomes readable once the shim has closed it
+            return bool(select.select([self.connection], [], [], 0)[0])
+
+        def handle(self):
+            # the shim stops waiting SHIM_TIMEOUT seconds after connecting
+            deadline = time.time() + RUN_TIMEOUT
+            try:
+                req = json.loads(self.rfile.readline())
+                returncode, output, errors = runner.run(
+                    req['plugin'], req.get('args', []), deadline=deadline,
+                    gone=self.gone)
+            except (ValueError, KeyError, OSError, IOError) as e:
+                returncode, output, errors = 1, 'status error %s\n' % e, ''
+            if self.gone():
+                return
+            self.wfile.write(json.dumps({'returncode': returncode,
+                                         'output': output,
+                                         'errors': errors}) + '\n')
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    try:
+        os.unlink(socket_path)
+    except OSError:
+        pass
+    server = Server(socket_path, Handler)
+    os.chmod(socket_path, 0o600)
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(socket_path)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        socket_path = sys.argv[2] if len(sys.argv) > 2 else SOCKET_PATH
+        serve(socket_path)
+    elif len(sys.argv) > 1:
+        sys.exit(shim(sys.argv[1:]))
+    else:
+        sys.exit('usage: %s --serve [socket] | PLUGIN [ARGS...]' %
+                 sys.argv[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -15,69 +15,224 @@
 # limitations under the License.
 
 import argparse
-import re
+import socket
 
 import ipaddr
+from maas_common import counter_increases
+from maas_common import fan_out
+from maas_common import history_path
+from maas_common import HISTORY_SAMPLES
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import parse_node
 from maas_common import print_output
+from maas_common import record_sample
 from maas_common import status_err
 from maas_common import status_ok
-import memcache
 
 
-VERSION_RE = re.compile('STAT version (\d+\.\d+\.\d+)(?![-+0-9\\.])')
 VERSIONS = ['1.4.14 (Ubuntu)', '1.4.15']
 MEMCACHE_METRICS = {'total_items': 'items',
                     'get_hits': 'cache_hits',
                     'get_misses': 'cache_misses',
                     'total_connections': 'connections'}
+# sent at once over one connection; each is answered by STAT lines and END
+COMMANDS = ['stats', 'stats settings', 'stats slabs', 'stats items']
+# counters of "stats" kept in the history of each server, the optional ones
+# are missing from older versions
+COUNTERS = ['get_hits', 'get_misses', 'evictions', 'total_connections',
+            'uptime']
+OPTIONAL_COUNTERS = ['rejected_connections']
+TIMEOUT = 10
+
+
+class MemcachedError(Exception):
+    pass
+
+
+def per_slab(section):
+    """Group "stats slabs" or "stats items" by slab class.
+
+    Their names look like "1:chunk_size" and "items:1:evicted"; the totals
+    without a slab class are left out.
+    """
+    slabs = {}
+    for name, value in section.items():
+        parts = name.split(':')
+        if len(parts) > 1 and parts[-2].isdigit():
+            slabs.setdefault(int(parts[-2]), {})[parts[-1]] = value
+    return slabs
 
 
 def item_stats(host, port):
-    """Check the stats for items and connection status."""
+    """Return the stats, settings, slabs and items of a memcached server.
 
-    stats = None
+    All the commands are written before any answer is read, so the server
+    is queried in a single round trip.
+    """
+    sock = socket.create_connection((host, port), TIMEOUT)
     try:
-        mc = memcache.Client(['%s:%s' % (host, port)])
-        stats = mc.get_stats()[0][1]
-    except IndexError:
-        raise
+        sock.sendall(''.join('%s\r\n' % command for command in COMMANDS))
+        answers = sock.makefile('rb')
+        sections = []
+        for command in COMMANDS:
+            section = {}
+            for line in iter(answers.readline, ''):
+                line = line.rstrip('\r\n')
+                if line == 'END':
+                    break
+                if not line.startswith('STAT '):
+                    raise MemcachedError('%s: %s' % (command, line))
+                _, name, value = line.split(' ', 2)
+                section[name] = value
+            else:
+                raise MemcachedError('connection closed during %s' % command)
+            sections.append(section)
     finally:
-        return stats
+        sock.close()
+    stats, settings, slabs, items = sections
+    return {'stats': stats, 'settings': settings, 'slabs': per_slab(slabs),
+            'items': per_slab(items)}
 
 
-def main(args):
+def node_increases(node, stats, samples=HISTORY_SAMPLES, window=None):
+    """Return the increases of the counters over the last ``samples`` runs.
 
-    bind_ip = str(args.ip)
-    port = args.port
-    is_up = True
+    The counters are kept in a history per node, of which only the last
+    ``window`` seconds are used when given. uptime going down tells that
+    memcached restarted and reset all of them, so the increases of a window
+    spanning a restart are those before it plus those after it.
+    """
+    counters = dict((name, int(stats['stats'][name]))
+                    for name in COUNTERS + OPTIONAL_COUNTERS
+                    if name in stats['stats'])
+    for slab, items in stats['items'].items():
+        counters['slab_%d_evicted' % slab] = int(items['evicted'])
+    history = record_sample(history_path('memcached_status', *node),
+                            counters, keep=samples)
+    return counter_increases(history, window=window, uptime='uptime')
 
-    try:
-        stats = item_stats(bind_ip, port)
-        current_version = stats['version']
-    except (TypeError, IndexError):
-        is_up = False
+
+def percent(part, total):
+    return '%.2f' % (100.0 * part / total)
+
+
+def print_metrics(stats, increases, seconds, top, suffix=''):
+    """Print the metrics of a server with ``suffix`` appended to them.
+
+    The cumulative counters and the slab classes are only reported for a
+    single server, they would use up the metric budget of several.
+    """
+    family = (lambda name: name) if suffix else (lambda name: None)
+
+    connections = stats['stats']['curr_connections']
+    maxconns = stats['settings'].get('maxconns')
+    if maxconns:
+        metric('memcache_connections_ratio' + suffix, 'double',
+               percent(int(connections), int(maxconns)), 'percent',
+               family=family('memcache_connections_ratio'))
+    if not suffix:
+        for m, u in MEMCACHE_METRICS.iteritems():
+            metric('memcache_%s' % m, 'uint64', stats['stats'][m], u)
+        metric('memcache_uptime', 'uint64', stats['stats']['uptime'],
+               'seconds')
+
+    # the rates over the window are known from the second run on
+    if not seconds:
+        return
+    gets = increases['get_hits'] + increases['get_misses']
+    if gets:
+        metric('memcache_hit_ratio' + suffix, 'double',
+               percent(increases['get_hits'], gets), 'percent',
+               family=family('memcache_hit_ratio'))
+    metric('memcache_evictions_per_second' + suffix, 'double',
+           '%.3f' % (increases['evictions'] / seconds), 'evictions',
+           family=family('memcache_evictions_per_second'))
+    if 'rejected_connections' in increases:
+        metric('memcache_connections_rejected_per_second' + suffix, 'double',
+               '%.3f' % (increases['rejected_connections'] / seconds),
+               'connections',
+               family=family('memcache_connections_rejected_per_second'))
+    if suffix:
+        return
+
+    # memory pressure shows as evictions from the slab classes which are
+    # full; the worst ones are reported
+    evicting = sorted(((increases.get('slab_%d_evicted' % slab, 0), slab)
+                       for slab in stats['items']), reverse=True)
+    evicting = [(evicted, slab) for evicted, slab in evicting if evicted]
+    metric('memcache_slabs_evicting', 'uint32', len(evicting), 'slabs')
+    for evicted, slab in evicting[:top]:
+        chunks = stats['slabs'].get(slab, {})
+        metric('memcache_slab_%d_evictions_per_second' % slab, 'double',
+               '%.3f' % (evicted / seconds), 'evictions',
+               family='memcache_slab_evictions_per_second')
+        if int(chunks.get('total_chunks', 0)):
+            metric('memcache_slab_%d_used' % slab, 'double',
+                   percent(int(chunks['used_chunks']),
+                           int(chunks['total_chunks'])), 'percent',
+                   family='memcache_slab_used')
+
+
+def main(args):
+
+    if args.nodes is not None:
+        nodes = [parse_node(spec, args.port)
+                 for spec in args.nodes.split(',') if spec.strip()]
+        if not nodes:
+            status_err('--nodes lists no memcached server')
+    elif args.ip:
+        nodes = [(str(args.ip), args.port)]
     else:
-        is_up = True
+        status_err('the memcached IP address or --nodes is needed')
+
+    results = fan_out(lambda node: item_stats(*node), nodes)
+
+    for (host, _), stats in zip(nodes, results):
+        if isinstance(stats, Exception):
+            continue
+        current_version = stats['stats']['version']
         if current_version not in VERSIONS:
             status_err('This plugin has only been tested with version %s '
-                       'of memcached, and you are using version %s'
-                       % (VERSIONS, current_version))
+                       'of memcached, and you are using version %s on %s'
+                       % (VERSIONS, current_version, host))
 
     status_ok()
-    metric_bool('memcache_api_local_status', is_up)
-    if is_up:
-        for m, u in MEMCACHE_METRICS.iteritems():
-            metric('memcache_%s' % m, 'uint64', stats[m], u)
+    # the metrics of each server are told apart by its address
+    multiple = len(nodes) > 1
+    for node, stats in zip(nodes, results):
+        suffix = ''
+        if multiple:
+            suffix = '_%s' % node[0]
+            if node[1] != args.port:
+                suffix += '_%d' % node[1]
+        is_up = not isinstance(stats, Exception)
+        metric_bool('memcache_api_local_status' + suffix, is_up)
+        if is_up:
+            increases, seconds = node_increases(node, stats, args.samples,
+                                                args.window)
+            print_metrics(stats, increases, seconds, args.top, suffix)
 
 
 if __name__ == '__main__':
     with print_output():
         parser = argparse.ArgumentParser(description='Check memcached status')
-        parser.add_argument('ip', type=ipaddr.IPv4Address,
+        parser.add_argument('ip', type=ipaddr.IPv4Address, nargs='?',
                             help='memcached IP address.')
         parser.add_argument('--port', type=int,
                             default=11211, help='memcached port.')
+        parser.add_argument('--nodes',
+                            help='Comma separated HOST[:PORT] list of '
+                                 'memcached servers to query in parallel '
+                                 'instead of a single one.')
+        parser.add_argument('--samples', type=int, default=HISTORY_SAMPLES,
+                            help='Number of runs whose counters are kept '
+                                 'to compute the rates over.')
+        parser.add_argument('--window', type=int,
+                            help='Only compute the rates over the runs of '
+                                 'the last WINDOW seconds.')
+        parser.add_argument('--top', type=int, default=3,
+                            help='Number of the most evicting slab classes '
+                                 'to report.')
         args = parser.parse_args()
         main(args)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# Copyright 2015, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Print the metrics a check spooled beyond the 30 it could report itself.
+
+When MAAS_METRIC_OVERFLOW=split, a check with more than 30 metrics prints
+the first chunk and reports the total number of chunks as metric_chunks.
+The other chunks are printed by this plugin, given the chunk number followed
+by the exact command line of the check::
+
+    metrics_spool.py 1 swift-recon.py replication object
+"""
+
+import argparse
+import time
+
+import maas_common
+
+
+def check(args):
+    spool = maas_common.read_json_file(
+        maas_common.spool_path([args.plugin] + args.args))
+    if spool is None:
+        # the check spools nothing while its metrics fit
+        maas_common.status_ok('Nothing spooled for %s' % args.plugin)
+        return
+
+    age = time.time() - spool['written_at']
+    if age > args.max_age:
+        maas_common.status_err('Metrics spooled by %s are %d seconds old' %
+                               (args.plugin, age))
+
+    maas_common.status_ok()
+    # the first chunk was printed by the check itself
+    chunks = spool['chunks']
+    if 0 < args.chunk <= len(chunks):
+        for name, metric_type, value, unit, family in chunks[args.chunk - 1]:
+            maas_common.metric(name, metric_type, value, unit, family)
+
+
+if __name__ == '__main__':
+    with maas_common.print_output(overflow='error'):
+        parser = argparse.ArgumentParser(
+            description='Print metrics spooled by a check')
+        parser.add_argument('--max-age',
+                            type=int,
+                            default=600,
+                            help='Seconds after which spooled metrics are '
+                                 'considered stale')
+        parser.add_argument('chunk', type=int,
+                            help='Number of the chunk to print, from 1')
+        parser.add_argument('plugin',
+                            help='Plugin whose metrics were spooled')
+        parser.add_argument('args', nargs=argparse.REMAINDER,
+                            help='Arguments the plugin was run with')
+        check(parser.parse_args())
@@ -33,6 +33,11 @@ def check(args):
 
     try:
         neutron = get_neutron_client(endpoint_url=NETWORK_ENDPOINT)
+        # time something arbitrary
+        start = time.time()
+        neutron.list_agents()
+        end = time.time()
+        milliseconds = (end - start) * 1000
         is_up = True
     # if we get a NeutronClientException don't bother sending any other metric
     # The API IS DOWN
@@ -42,12 +47,6 @@ def check(args):
     except Exception as e:
         status_err(str(e))
     else:
-        # time something arbitrary
-        start = time.time()
-        neutron.list_agents()
-        end = time.time()
-        milliseconds = (end - start) * 1000
-
         # gather some metrics
         networks = len(neutron.list_networks()['networks'])
         agents = len(neutron.list_agents()['agents'])
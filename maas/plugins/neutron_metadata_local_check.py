@@ -15,10 +15,14 @@
 # limitations under the License.
 
 import argparse
+import json
 import shlex
 import subprocess
+import time
 
+from maas_common import fan_out
 from maas_common import get_neutron_client
+from maas_common import metric
 from maas_common import metric_bool
 from maas_common import print_output
 from maas_common import status_err
@@ -27,7 +31,121 @@ from maas_common import status_ok
 # identify the first active neutron agents container on this host
 # network namespaces can only be accessed from within neutron agents container
 FIND_CONTAINER = shlex.split('lxc-ls -1 --running .*neutron_agents')
-SERVICE_CHECK = 'ip netns exec %s curl -fvs 169.254.169.254:80'
+SERVICE_CHECK = ('ip netns exec %s curl -fvs --max-time %d '
+                 '169.254.169.254:80')
+HELPER_PYTHON = 'python'
+# Probes every network from a single process inside the container. Each
+# worker thread joins a qdhcp namespace with setns(2), which only affects
+# the calling thread, and speaks HTTP to the metadata proxy directly.
+# Network ids are read from stdin and one JSON result per line is streamed
+# back as soon as each probe finishes.
+HELPER = r'''
+import ctypes, json, os, socket, sys, threading, time
+CLONE_NEWNET = 0x40000000
+libc = ctypes.CDLL(None, use_errno=True)
+timeout, concurrency = float(sys.argv[1]), int(sys.argv[2])
+nets = [line.strip() for line in sys.stdin if line.strip()]
+lock = threading.Lock()
+
+
+def probe(net_id):
+    start = time.time()
+    is_ok = False
+    try:
+        fd = os.open('/var/run/netns/qdhcp-' + net_id, os.O_RDONLY)
+        try:
+            if libc.setns(fd, CLONE_NEWNET) != 0:
+                raise OSError(ctypes.get_errno(), 'setns failed')
+        finally:
+            os.close(fd)
+        sock = socket.create_connection(('169.254.169.254', 80), timeout)
+        try:
+            sock.sendall(b'GET / HTTP/1.0\r\nHost: 169.254.169.254\r\n\r\n')
+            code = int(sock.recv(64).split()[1])
+            # same verdict as curl -f, plus the expected 404
+            is_ok = code < 400 or code == 404
+        finally:
+            sock.close()
+    except Exception:
+        pass
+    result = json.dumps({'net': net_id, 'ok': is_ok,
+                         'ms': (time.time() - start) * 1000})
+    with lock:
+        sys.stdout.write(result + '\n')
+        sys.stdout.flush()
+
+
+def worker():
+    while True:
+        with lock:
+            if not nets:
+                return
+            net_id = nets.pop()
+        probe(net_id)
+
+
+threads = [threading.Thread(target=worker)
+           for _ in range(min(concurrency, len(nets)))]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+'''
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of a sorted list of values."""
+    if not values:
+        return 0
+    rank = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def probe(container, net_id, timeout):
+    """Check the metadata proxy of one network.
+
+    Returns (net_id, is_ok, milliseconds).
+    """
+    namespace = 'qdhcp-%s' % net_id
+    service_check_cmd = SERVICE_CHECK % (namespace, timeout)
+    command = shlex.split('lxc-attach -n %s -- %s' % (container,
+                                                      service_check_cmd))
+    start = time.time()
+    try:
+        subprocess.check_output(command, stderr=subprocess.STDOUT)
+        is_ok = True
+    except subprocess.CalledProcessError as e:
+        # HTTP 404 response indicates the service is responsive.
+        # this is the expected response because the maas testing host IP
+        # is used to look up metadata and no metadata exists for this IP
+        is_ok = '404 Not Found' in e.output
+    return net_id, is_ok, (time.time() - start) * 1000
+
+
+def probe_with_helper(container, nets, timeout, concurrency):
+    """Check the metadata proxies of all networks with one lxc-attach.
+
+    Returns a list of (net_id, is_ok, milliseconds); networks the helper
+    did not report on are counted as failed.
+    """
+    command = ['lxc-attach', '-n', container, '--', HELPER_PYTHON, '-c',
+               HELPER, str(timeout), str(concurrency)]
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    proc.stdin.write(''.join('%s\n' % net_id for net_id in nets))
+    proc.stdin.close()
+
+    results = {}
+    for line in iter(proc.stdout.readline, ''):
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        results[result['net']] = (result['net'], result['ok'], result['ms'])
+    if proc.wait() != 0 and not results:
+        status_err('metadata probe helper failed in %s with exit code %d' %
+                   (container, proc.returncode))
+    return [results.get(net_id, (net_id, False, 0)) for net_id in nets]
 
 
 def check(args):
@@ -42,38 +160,44 @@ def check(args):
     try:
         neutron = get_neutron_client(endpoint_url=network_endpoint)
 
+        # only check networks which have a port with DHCP enabled
+        ports = neutron.list_ports(device_owner='network:dhcp')['ports']
+
     # not gathering api status metric here so catch any exception
     except Exception as e:
         status_err(str(e))
 
-    # only check networks which have a port with DHCP enabled
-    ports = neutron.list_ports(device_owner='network:dhcp')['ports']
     nets = set([p['network_id'] for p in ports])
 
-    # perform checks for each identified network
-    failures = []
-    for net_id in nets:
-        namespace = 'qdhcp-%s' % net_id
-        service_check_cmd = SERVICE_CHECK % namespace
-        command = shlex.split('lxc-attach -n %s -- %s' % (container,
-                                                          service_check_cmd))
-        try:
-            subprocess.check_output(command, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            # HTTP 404 response indicates the service is responsive.
-            # this is the expected response because the maas testing host IP
-            # is used to look up metadata and no metadata exists for this IP
-            if '404 Not Found' not in e.output:
-                failures.append(net_id)
+    # perform checks for each identified network, at most
+    # args.concurrency at a time
+    results = []
+    if nets and args.mode == 'helper':
+        results = probe_with_helper(container, nets, args.probe_timeout,
+                                    args.concurrency)
+    elif nets:
+        results = fan_out(
+            lambda net_id: probe(container, net_id, args.probe_timeout),
+            nets, workers=args.concurrency)
 
-    is_ok = len(failures) == 0
-    metric_bool('neutron-metadata-agent-proxy_status', is_ok)
+    failures = [net_id for net_id, is_ok, _ in results if not is_ok]
+    latencies = sorted(ms for _, _, ms in results)
 
+    is_ok = len(failures) == 0
+    # report failures through the metrics, status_err would discard them
     if is_ok:
         status_ok()
     else:
-        status_err('neutron metadata agent proxies fail on host %s '
-                   'net_ids: %s' % (container, ','.join(failures)))
+        status_ok('neutron metadata agent proxies fail on host %s '
+                  'net_ids: %s' % (container, ','.join(failures)))
+
+    metric_bool('neutron-metadata-agent-proxy_status', is_ok)
+    metric('neutron-metadata-agent-proxy_failed_networks', 'uint32',
+           len(failures), 'networks')
+    metric('neutron-metadata-agent-proxy_probe_p50', 'double',
+           '%.3f' % percentile(latencies, 50), 'ms')
+    metric('neutron-metadata-agent-proxy_probe_p95', 'double',
+           '%.3f' % percentile(latencies, 95), 'ms')
 
 
 def main(args):
@@ -86,4 +210,19 @@ if __name__ == "__main__":
         parser.add_argument('neutron_host',
                             type=str,
                             help='Neutron API hostname or IP address')
+        parser.add_argument('--concurrency',
+                            type=int,
+                            default=10,
+                            help='Number of networks probed at once')
+        parser.add_argument('--probe-timeout',
+                            type=int,
+                            default=5,
+                            help='Seconds allowed for each probe')
+        parser.add_argument('--mode',
+                            choices=['exec', 'helper'],
+                            default='exec',
+                            help='exec runs curl through lxc-attach for '
+                                 'each network; helper enters the '
+                                 'container once and probes every network '
+                                 'from a single process')
         main(parser.parse_args())
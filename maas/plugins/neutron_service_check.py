@@ -16,12 +16,33 @@
 
 import argparse
 
+from maas_common import get_cluster_snapshot
 from maas_common import get_neutron_client
 from maas_common import metric_bool
 from maas_common import print_output
+from maas_common import report_service_states
 from maas_common import status_err
 from maas_common import status_ok
 
+AGENT_FIELDS = ('binary', 'id', 'host', 'admin_state_up', 'alive')
+
+
+def get_agents(neutron, args):
+    """Return the agents of args.host, or of every host."""
+    if args.snapshot:
+        snapshot = get_cluster_snapshot(
+            'neutron_agents', args.snapshot_age,
+            lambda: [[a[field] for field in AGENT_FIELDS]
+                     for a in neutron.list_agents()['agents']],
+            servers=args.memcached, path=args.snapshot_file)
+        if snapshot is not None:
+            return [dict(zip(AGENT_FIELDS, row)) for row in snapshot
+                    if not args.host or row[2] == args.host]
+
+    if args.host:
+        return neutron.list_agents(host=args.host)['agents']
+    return neutron.list_agents()['agents']
+
 
 def check(args):
 
@@ -29,21 +50,34 @@ def check(args):
     try:
         neutron = get_neutron_client(endpoint_url=NETWORK_ENDPOINT)
 
+        # gather neutron agent states
+        agents = get_agents(neutron, args)
+
     # not gathering api status metric here so catch any exception
     except Exception as e:
         status_err(str(e))
 
-    # gather nova service states
-    if args.host:
-        agents = neutron.list_agents(host=args.host)['agents']
-    else:
-        agents = neutron.list_agents()['agents']
-
     if len(agents) == 0:
         status_err("No host(s) found in the agents list")
 
-    # return all the things
     status_ok()
+    if args.aggregate and not args.host:
+        states = {}
+        for agent in agents:
+            if not agent['admin_state_up']:
+                state = 'disabled'
+            elif agent['alive']:
+                state = 'up'
+            else:
+                state = 'down'
+            name = '%s_%s_on_host_%s' % (agent['binary'],
+                                         agent['id'],
+                                         agent['host'])
+            states[name] = (agent['binary'], state)
+        report_service_states(states, args.state_file)
+        return
+
+    # return all the things
     for agent in agents:
         agent_is_up = True
         if agent['admin_state_up'] and not agent['alive']:
@@ -73,5 +107,37 @@ if __name__ == "__main__":
                             type=str,
                             help='Only return metrics for specified host',
                             default=None)
+        parser.add_argument('--aggregate',
+                            action='store_true',
+                            help='Without --host, report the number of '
+                                 'agents up, down and disabled per binary '
+                                 'and only the agents which changed state '
+                                 'since the previous run')
+        parser.add_argument('--state-file',
+                            type=str,
+                            help='Where --aggregate records agent states',
+                            default='/root/.maas_neutron_agent_states.json')
+        parser.add_argument('--snapshot',
+                            action='store_true',
+                            help='Read the agents from a snapshot shared by '
+                                 'all the checks, published by whichever '
+                                 'check finds it stale, through --memcached '
+                                 'or --snapshot-file')
+        parser.add_argument('--snapshot-age',
+                            type=int,
+                            help='Seconds after which the snapshot is stale',
+                            default=120)
+        parser.add_argument('--snapshot-file',
+                            type=str,
+                            help='Where the snapshot is kept when no '
+                                 'memcached servers are given; only for a '
+                                 'file the checks of several hosts share',
+                            default=None)
+        parser.add_argument('--memcached',
+                            type=lambda servers: [
+                                s for s in servers.split(',') if s],
+                            help='Comma separated memcached host:port list '
+                                 'holding the snapshot',
+                            default=None)
         args = parser.parse_args()
         main(args)
@@ -44,6 +44,11 @@ def check(args):
     try:
         nova = get_nova_client(auth_token=auth_token,
                                bypass_url=COMPUTE_ENDPOINT)
+        # time something arbitrary
+        start = time.time()
+        nova.services.list()
+        end = time.time()
+        milliseconds = (end - start) * 1000
         is_up = True
     except exc.ClientException:
         is_up = False
@@ -51,12 +56,6 @@ def check(args):
     except Exception as e:
         status_err(str(e))
     else:
-        # time something arbitrary
-        start = time.time()
-        nova.services.list()
-        end = time.time()
-        milliseconds = (end - start) * 1000
-
         servers = nova.servers.list(search_opts={'all_tenants': 1})
         # gather some metrics
         status_count = collections.Counter([s.status for s in servers])
@@ -15,14 +15,37 @@
 # limitations under the License.
 
 import argparse
+import collections
 
 from maas_common import get_auth_ref
+from maas_common import get_cluster_snapshot
 from maas_common import get_nova_client
 from maas_common import metric_bool
 from maas_common import print_output
+from maas_common import report_service_states
 from maas_common import status_err
 from maas_common import status_ok
 
+Service = collections.namedtuple('Service', ['binary', 'host', 'status',
+                                             'state'])
+
+
+def get_services(nova, args):
+    """Return the services of args.host, or of every host."""
+    if args.snapshot:
+        snapshot = get_cluster_snapshot(
+            'nova_services', args.snapshot_age,
+            lambda: [[s.binary, s.host, s.status, s.state]
+                     for s in nova.services.list()],
+            servers=args.memcached, path=args.snapshot_file)
+        if snapshot is not None:
+            return [Service(*row) for row in snapshot
+                    if not args.host or row[1] == args.host]
+
+    if args.host:
+        return nova.services.list(host=args.host)
+    return nova.services.list()
+
 
 def check(args):
     auth_ref = get_auth_ref()
@@ -37,21 +60,30 @@ def check(args):
         nova = get_nova_client(auth_token=auth_token,
                                bypass_url=COMPUTE_ENDPOINT)
 
+        # gather nova service states
+        services = get_services(nova, args)
+
     # not gathering api status metric here so catch any exception
     except Exception as e:
         status_err(str(e))
 
-    # gather nova service states
-    if args.host:
-        services = nova.services.list(host=args.host)
-    else:
-        services = nova.services.list()
-
     if len(services) == 0:
         status_err("No host(s) found in the service list")
 
-    # return all the things
     status_ok()
+    if args.aggregate and not args.host:
+        states = {}
+        for service in services:
+            if service.status != 'enabled':
+                state = 'disabled'
+            else:
+                state = service.state
+            name = '%s_on_host_%s_status' % (service.binary, service.host)
+            states[name] = (service.binary, state)
+        report_service_states(states, args.state_file)
+        return
+
+    # return all the things
     for service in services:
         service_is_up = True
 
@@ -80,6 +112,38 @@ if __name__ == "__main__":
                             type=str,
                             help='Only return metrics for specified host',
                             default=None)
+        parser.add_argument('--aggregate',
+                            action='store_true',
+                            help='Without --host, report the number of '
+                                 'services up, down and disabled per binary '
+                                 'and only the services which changed state '
+                                 'since the previous run')
+        parser.add_argument('--state-file',
+                            type=str,
+                            help='Where --aggregate records service states',
+                            default='/root/.maas_nova_service_states.json')
+        parser.add_argument('--snapshot',
+                            action='store_true',
+                            help='Read the services from a snapshot shared by '
+                                 'all the checks, published by whichever '
+                                 'check finds it stale, through --memcached '
+                                 'or --snapshot-file')
+        parser.add_argument('--snapshot-age',
+                            type=int,
+                            help='Seconds after which the snapshot is stale',
+                            default=120)
+        parser.add_argument('--snapshot-file',
+                            type=str,
+                            help='Where the snapshot is kept when no '
+                                 'memcached servers are given; only for a '
+                                 'file the checks of several hosts share',
+                            default=None)
+        parser.add_argument('--memcached',
+                            type=lambda servers: [
+                                s for s in servers.split(',') if s],
+                            help='Comma separated memcached host:port list '
+                                 'holding the snapshot',
+                            default=None)
         args = parser.parse_args()
 
         main(args)
@@ -15,19 +15,35 @@
 # limitations under the License.
 
 
+import heapq
 import optparse
+import re
 import subprocess
 
+from maas_common import counter_rates
+from maas_common import fan_out
+from maas_common import history_path
+from maas_common import json_items
+from maas_common import json_values
+from maas_common import MAX_METRICS
 from maas_common import metric
 from maas_common import metric_bool
 from maas_common import print_output
+from maas_common import record_sample
 from maas_common import status_err
 from maas_common import status_ok
 import requests
+from requests import adapters
 
 OVERVIEW_URL = "http://%s:%s/api/overview"
 NODES_URL = "http://%s:%s/api/nodes"
-CONNECTIONS_URL = "http://%s:%s/api/connections?columns=channels"
+# only the connection with the most channels is asked for
+CONNECTIONS_URL = ("http://%s:%s/api/connections?columns=channels"
+                   "&sort=channels&sort_reverse=true&page=1&page_size=1")
+QUEUES_URL = ("http://%s:%s/api/queues?columns=name,vhost,messages,"
+              "messages_unacknowledged,consumers")
+VHOSTS_URL = ("http://%s:%s/api/vhosts?columns=name,message_stats.publish,"
+              "message_stats.deliver_get")
 
 CLUSTERED = True
 CLUSTER_SIZE = 3
@@ -56,6 +72,16 @@ NODES_METRICS = {"proc_used": "processes",
 
 CONNECTIONS_METRICS = {"max_channels_per_conn": "channels"}
 
+# {ranking: metric name suffix}; the top queues of each ranking are reported
+QUEUE_RANKINGS = {"messages": "messages",
+                  "unacked": "messages_unacknowledged",
+                  "no_consumers": "messages_without_consumers"}
+# {vhost counter: rate metric name suffix}; the counters of the vhosts are
+# used rather than the sums of those of their queues, which go down whenever
+# a queue is deleted and would be taken for a reset
+VHOST_RATES = {"publish": "publish_per_second",
+               "deliver_get": "deliver_get_per_second"}
+
 
 def hostname():
     """Return the name of the current host/node."""
@@ -91,89 +117,214 @@ def parse_args():
                       default=None,
                       help=("Check a node's cluster membership using the "
                             'provided name'))
+    parser.add_option('--queues', action='store_true', dest='queues',
+                      default=False,
+                      help='Report the depth of each vhost and of the '
+                           'deepest queues instead of the node status')
+    parser.add_option('--top', action='store', dest='top', type='int',
+                      default=5,
+                      help='Number of queues reported for each of the '
+                           'messages, unacked and no consumers rankings')
     return parser.parse_args()
 
 
+def max_channels(response):
+    """Return the most channels open on a connection, or None.
+
+    RabbitMQ 3.6 and later answer CONNECTIONS_URL with a single page holding
+    the busiest connection; older versions ignore the paging and sorting
+    parameters and list every connection, which is then streamed.
+    """
+    most = None
+    for channels in json_values(response, 'items.item.channels',
+                                'item.channels'):
+        if most is None or channels > most:
+            most = channels
+    return most
+
+
+def metric_name(name):
+    """Make a vhost or queue name usable in a metric name."""
+    return re.sub(r'[^\w.-]+', '_', name).strip('_') or 'default'
+
+
+def push(heap, size, item):
+    """Keep the ``size`` largest items pushed onto ``heap``."""
+    if len(heap) < size:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+def queue_stats(queues, top):
+    """Sum the queues of each vhost and rank the deepest queues.
+
+    Return ({vhost: totals}, {ranking: [(value, vhost, queue)]}), where each
+    ranking of QUEUE_RANKINGS holds its ``top`` queues, largest first.
+    ``queues`` may be an iterator; only the ranked queues are kept while it
+    is read.
+    """
+    vhosts = {}
+    rankings = dict((ranking, []) for ranking in QUEUE_RANKINGS)
+    for queue in queues:
+        totals = vhosts.setdefault(queue['vhost'], {
+            'queues': 0, 'messages': 0, 'unacked': 0, 'no_consumers': 0})
+        # queues created since the last statistics update have no counts
+        messages = queue.get('messages') or 0
+        unacked = queue.get('messages_unacknowledged') or 0
+        totals['queues'] += 1
+        totals['messages'] += messages
+        totals['unacked'] += unacked
+
+        key = (queue['vhost'], queue['name'])
+        if messages:
+            push(rankings['messages'], top, (messages,) + key)
+        if unacked:
+            push(rankings['unacked'], top, (unacked,) + key)
+        if messages and not queue.get('consumers'):
+            totals['no_consumers'] += 1
+            push(rankings['no_consumers'], top, (messages,) + key)
+    return vhosts, dict((ranking, sorted(heap, reverse=True))
+                        for ranking, heap in rankings.items())
+
+
+def vhost_counters(vhosts):
+    """Return {'VHOST COUNTER': value} of the VHOST_RATES counters."""
+    return dict(('%s %s' % (vhost['name'], counter),
+                 vhost['message_stats'][counter])
+                for vhost in vhosts for counter in VHOST_RATES
+                if counter in (vhost.get('message_stats') or {}))
+
+
+def check_queues(options, session):
+    # the two requests are made at once, each over its own connection
+    urls = [url % (options.host, options.port)
+            for url in (QUEUES_URL, VHOSTS_URL)]
+    session.mount('http://', adapters.HTTPAdapter(pool_maxsize=len(urls)))
+    # the queues are streamed, there may be thousands of them
+    responses = fan_out(lambda url: session.get(url, stream=url == urls[0]),
+                        urls, errors=requests.exceptions.RequestException)
+    for r in responses:
+        if isinstance(r, Exception):
+            status_err(str(r))
+        if not r.ok:
+            status_err('Received status {0} from RabbitMQ API'.format(
+                r.status_code))
+    queues, vhost_list = responses
+
+    # the queues are read one at a time as the listing arrives
+    vhosts, rankings = queue_stats(json_items(queues, 'item'), options.top)
+    history = record_sample(
+        history_path('rabbitmq_vhosts', options.host, options.port),
+        vhost_counters(vhost_list.json()))
+    rates = counter_rates(history)
+
+    status_ok()
+    metric('rabbitmq_queues', 'uint32',
+           sum(t['queues'] for t in vhosts.values()), 'queues')
+    metric('rabbitmq_queues_without_consumers', 'uint32',
+           sum(t['no_consumers'] for t in vhosts.values()), 'queues')
+
+    # the busiest vhosts get at most half of the metrics, the rest is shared
+    # between the rankings
+    budget = MAX_METRICS - 2
+    per_vhost = 2 + len(VHOST_RATES)
+    busiest = sorted(vhosts, key=lambda v: vhosts[v]['messages'],
+                     reverse=True)[:budget // 2 // per_vhost]
+    for vhost in busiest:
+        name = 'rabbitmq_vhost_%s' % metric_name(vhost)
+        metric('%s_messages' % name, 'int64', vhosts[vhost]['messages'],
+               'messages', family='rabbitmq_vhost_messages')
+        metric('%s_messages_unacknowledged' % name, 'int64',
+               vhosts[vhost]['unacked'], 'messages',
+               family='rabbitmq_vhost_messages_unacknowledged')
+        for counter, suffix in sorted(VHOST_RATES.items()):
+            rate = rates.get('%s %s' % (vhost, counter))
+            if rate is not None:
+                metric('%s_%s' % (name, suffix), 'double', '%.3f' % rate,
+                       'messages', family='rabbitmq_vhost_%s' % suffix)
+
+    budget -= len(busiest) * per_vhost
+    for ranking, suffix in sorted(QUEUE_RANKINGS.items()):
+        for value, vhost, queue in rankings[ranking][:budget // 3]:
+            if vhost != '/':
+                queue = '%s.%s' % (metric_name(vhost), queue)
+            metric('rabbitmq_queue_%s_%s' % (metric_name(queue), suffix),
+                   'int64', value, 'messages',
+                   family='rabbitmq_queue_%s' % suffix)
+
+
 def main():
     (options, _) = parse_args()
     metrics = {}
     s = requests.Session()  # Make a Session to store the authenticate creds
     s.auth = (options.username, options.password)
 
-    try:
-        r = s.get(CONNECTIONS_URL % (options.host, options.port))
-    except requests.exceptions.ConnectionError as e:
-        status_err(str(e))
-
-    if r.ok:
-        resp_json = r.json()  # Parse the JSON once
-        if resp_json:
-            max_chans = max(connection['channels'] for connection in resp_json
-                            if 'channels' in connection)
-            for k in CONNECTIONS_METRICS:
-                metrics[k] = {'value': max_chans,
-                              'unit': CONNECTIONS_METRICS[k]}
-    else:
-        status_err('Received status {0} from RabbitMQ API'.format(
-            r.status_code))
-
-    try:
-        r = s.get(OVERVIEW_URL % (options.host, options.port))
-    except requests.exceptions.ConnectionError as e:
-        status_err(str(e))
-
-    if r.ok:
-        resp_json = r.json()  # Parse the JSON once
-        for k in OVERVIEW_METRICS:
-            if k in resp_json:
-                for a, b in OVERVIEW_METRICS[k].items():
-                    if a in resp_json[k]:
-                        metrics[a] = {'value': resp_json[k][a], 'unit': b}
-    else:
-        status_err('Received status {0} from RabbitMQ API'.format(
-            r.status_code))
+    if options.queues:
+        check_queues(options, s)
+        return
 
-    try:
-        r = s.get(NODES_URL % (options.host, options.port))
-    except requests.exceptions.ConnectionError as e:
-        status_err(str(e))
+    # the three requests are made at once, each over its own connection
+    urls = [url % (options.host, options.port)
+            for url in (CONNECTIONS_URL, OVERVIEW_URL, NODES_URL)]
+    s.mount('http://', adapters.HTTPAdapter(pool_maxsize=len(urls)))
+    # the connections are streamed in case they are all listed
+    responses = fan_out(lambda url: s.get(url, stream=url == urls[0]),
+                        urls, errors=requests.exceptions.RequestException)
+
+    for r in responses:
+        if isinstance(r, Exception):
+            status_err(str(r))
+        if not r.ok:
+            status_err('Received status {0} from RabbitMQ API'.format(
+                r.status_code))
+    connections, overview, nodes = responses
+
+    max_chans = max_channels(connections)
+    if max_chans is not None:
+        for k in CONNECTIONS_METRICS:
+            metrics[k] = {'value': max_chans,
+                          'unit': CONNECTIONS_METRICS[k]}
+
+    resp_json = overview.json()  # Parse the JSON once
+    for k in OVERVIEW_METRICS:
+        if k in resp_json:
+            for a, b in OVERVIEW_METRICS[k].items():
+                if a in resp_json[k]:
+                    metrics[a] = {'value': resp_json[k][a], 'unit': b}
 
     # Either use the option provided by the commandline flag or the current
     # hostname
     name = '@' + (options.name or hostname())
     is_cluster_member = False
-    if r.ok:
-        resp_json = r.json()
-        # Ensure this node is a member of the cluster
-        nodes_matching_name = [n for n in resp_json
-                               if n['name'].endswith(name)]
-        is_cluster_member = any(nodes_matching_name)
-
-        if CLUSTERED:
-            if len(r.json()) < CLUSTER_SIZE:
-                status_err('cluster too small')
-            if not is_cluster_member:
-                status_err('{0} not a member of the cluster'.format(name))
-
-        for k, v in NODES_METRICS.items():
-            metrics[k] = {'value': nodes_matching_name[0][k], 'unit': v}
-
-        # We don't know exactly which version introduces data for all
-        #   nodes in the cluster returned by the NODES_URL, but we know it is
-        #   in 3.5.x at least.
-        if rabbit_version(nodes_matching_name[0]) > (3, 5):
-            # Gather the queue lengths for all nodes in the cluster
-            queues = [n['run_queue'] for n in resp_json
-                      if n.get('run_queue', None)]
-            # Grab the first queue length
-            first = queues.pop()
-            # Check that all other queues are equal to it
-            if not all(first == q for q in queues):
-                # If they're not, the queues are not synchronized
-                status_err('Cluster not replicated across all nodes')
-    else:
-        status_err('Received status {0} from RabbitMQ API'.format(
-            r.status_code))
+    resp_json = nodes.json()
+    # Ensure this node is a member of the cluster
+    nodes_matching_name = [n for n in resp_json
+                           if n['name'].endswith(name)]
+    is_cluster_member = any(nodes_matching_name)
+
+    if CLUSTERED:
+        if len(resp_json) < CLUSTER_SIZE:
+            status_err('cluster too small')
+        if not is_cluster_member:
+            status_err('{0} not a member of the cluster'.format(name))
+
+    for k, v in NODES_METRICS.items():
+        metrics[k] = {'value': nodes_matching_name[0][k], 'unit': v}
+
+    # We don't know exactly which version introduces data for all
+    #   nodes in the cluster returned by the NODES_URL, but we know it is
+    #   in 3.5.x at least.
+    if rabbit_version(nodes_matching_name[0]) > (3, 5):
+        # Gather the queue lengths for all nodes in the cluster
+        queues = [n['run_queue'] for n in resp_json
+                  if n.get('run_queue', None)]
+        # Grab the first queue length
+        first = queues.pop() if queues else None
+        # Check that all other queues are equal to it
+        if not all(first == q for q in queues):
+            # If they're not, the queues are not synchronized
+            status_err('Cluster not replicated across all nodes')
 
     status_ok()
 
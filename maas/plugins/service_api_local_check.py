@@ -18,7 +18,8 @@ import argparse
 
 import ipaddr
 from maas_common import get_auth_ref
-from maas_common import get_keystone_client
+from maas_common import get_project_id
+from maas_common import get_requests_session
 from maas_common import metric
 from maas_common import metric_bool
 from maas_common import print_output
@@ -28,15 +29,15 @@ from requests import exceptions as exc
 
 
 def check(args):
-    headers = {'Content-type': 'application/json'}
     path_options = {}
     if args.auth:
         auth_ref = get_auth_ref()
-        keystone = get_keystone_client(auth_ref)
-        auth_token = keystone.auth_token
-        project_id = keystone.project_id
-        headers['auth_token'] = auth_token
-        path_options['project_id'] = project_id
+        path_options['project_id'] = get_project_id(auth_ref)
+        # a token rejected with 401 is renewed and the request retried
+        s = get_requests_session(auth_ref['auth_token'])
+    else:
+        s = requests.Session()
+        s.headers.update({'Content-type': 'application/json'})
 
     scheme = args.ssl and 'https' or 'http'
     endpoint = '{scheme}://{ip}:{port}'.format(ip=args.ip, port=args.port,
@@ -45,10 +46,6 @@ def check(args):
         path_options['version'] = args.version
     path = args.path.format(path_options)
 
-    s = requests.Session()
-
-    s.headers.update(headers)
-
     if path and not path.startswith('/'):
         url = '/'.join((endpoint, path))
     else:
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# Copyright 2015, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare loading large API responses whole against streaming them.
+
+Synthetic glance image and RabbitMQ connection listings are served over
+HTTP, and each is aggregated the way glance_api_local_check and
+rabbitmq_status do, once with response.json() and once with
+maas_common.json_values, each in a fresh interpreter. Streaming needs ijson.
+
+    ./bench_json_streaming.py --entries 100000
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'plugins')
+# (payload, ijson prefix of the aggregated values, aggregate)
+PAYLOADS = [('images.json', 'images.item.status', 'collections.Counter'),
+            ('connections.json', 'item.channels', 'max')]
+AGGREGATE = """
+import collections, sys
+sys.path.insert(0, sys.argv[1])
+import maas_common, requests
+url, prefix, mode = sys.argv[2:5]
+r = requests.get(url, stream=mode == 'stream')
+if mode == 'stream':
+    values = maas_common.json_values(r, prefix)
+else:
+    values = maas_common.walk_json(r.json(), prefix.split('.'))
+result = %s(values)
+with open('/proc/self/status') as status:
+    # ru_maxrss would include the memory of the benchmark before exec
+    print([l.split()[1] for l in status if l.startswith('VmHWM:')][0])
+print(result)
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=100000,
+                        help='Images and connections in the payloads.')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Runs for each mode; the median is reported.')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port to serve the payloads on.')
+    parser.add_argument('--plugin-dir', default=PLUGIN_DIR)
+    return parser.parse_args()
+
+
+def write_payloads(directory, entries):
+    images = {'images': [
+        {'id': '%08d-0000-4000-8000-000000000000' % i,
+         'name': 'image-%d' % i,
+         'status': ('active', 'queued', 'killed')[i % 7 % 3],
+         'size': 1 << 30, 'disk_format': 'qcow2',
+         'container_format': 'bare', 'checksum': '%032x' % i,
+         'created_at': '2015-01-01T00:00:00', 'is_public': True,
+         'properties': {'status': 'ignored', 'os_distro': 'ubuntu'}}
+        for i in range(entries)]}
+    connections = [
+        {'name': '10.0.%d.%d:%d -> 10.0.0.1:5672' % (i // 250 % 250,
+                                                     i % 250, 40000 + i),
+         'node': 'rabbit@rabbit%d' % (i % 3 + 1), 'channels': i % 97,
+         'user': 'nova', 'vhost': '/', 'state': 'running',
+         'recv_oct': i * 1024, 'send_oct': i * 2048}
+        for i in range(entries)]
+    for name, payload in (('images.json', images),
+                          ('connections.json', connections)):
+        with open(os.path.join(directory, name), 'w') as f:
+            json.dump(payload, f)
+
+
+def serve(directory, port):
+    """Serve ``directory`` from another interpreter until it is killed."""
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen([sys.executable, '-m', 'SimpleHTTPServer',
+                                 str(port)], cwd=directory, stdout=devnull,
+                                stderr=devnull)
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return proc
+        except socket.error:
+            time.sleep(0.1)
+    proc.kill()
+    sys.exit('Could not serve the payloads on port %d' % port)
+
+
+def timed_run(command):
+    """Run ``command``; return (wall ms, peak RSS KB, aggregate)."""
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        output = subprocess.check_output(command, stderr=devnull)
+        elapsed = (time.time() - start) * 1000
+    rss, result = output.split('\n', 1)
+    return elapsed, int(rss), result.strip()
+
+
+def main():
+    args = parse_args()
+    try:
+        import ijson  # noqa
+        modes = ['json', 'stream']
+    except ImportError:
+        print('ijson is not installed, only loading whole responses')
+        modes = ['json']
+
+    directory = tempfile.mkdtemp(prefix='bench_json_streaming.')
+    try:
+        write_payloads(directory, args.entries)
+        server = serve(directory, args.port)
+        try:
+            for payload, prefix, aggregate in PAYLOADS:
+                url = 'http://127.0.0.1:%d/%s' % (args.port, payload)
+                size = os.path.getsize(os.path.join(directory, payload))
+                print('%s: %d entries, %.1fMB' %
+                      (payload, args.entries, size / 1048576.0))
+                for mode in modes:
+                    samples = sorted(
+                        timed_run([sys.executable, '-c',
+                                   AGGREGATE % aggregate, args.plugin_dir,
+                                   url, prefix, mode])
+                        for _ in range(args.runs))
+                    elapsed, rss, output = samples[len(samples) // 2]
+                    print('  %-6s %8.1fms %8dKB  %s' % (mode, elapsed, rss,
+                                                        output[:60]))
+        finally:
+            server.kill()
+            server.wait()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
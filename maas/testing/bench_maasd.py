@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Copyright 2015, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare fork-per-check plugin runs against runs through maasd.py.
+
+    ./bench_maasd.py --runs 20 nova_api_local_check.py 172.29.236.100
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'plugins')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Number of runs for each mode.')
+    parser.add_argument('--plugin-dir', default=PLUGIN_DIR,
+                        help='Directory containing the plugins and maasd.py')
+    parser.add_argument('plugin', help='Plugin file name, e.g. '
+                                       'conntrack_count.py')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='Arguments passed to the plugin.')
+    return parser.parse_args()
+
+
+def timed_run(command, env=None):
+    """Run ``command``; return its wall time in ms and peak RSS in KB."""
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        proc = subprocess.Popen(command, stdout=devnull, stderr=devnull,
+                                env=env)
+        _, _, rusage = os.wait4(proc.pid, 0)
+        elapsed = (time.time() - start) * 1000
+    return elapsed, rusage.ru_maxrss
+
+
+def peak_rss(pid):
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return 0
+
+
+def summarise(mode, samples, extra_rss=0):
+    walls = sorted(s[0] for s in samples)
+    rss = max(s[1] for s in samples)
+    print('%-8s runs=%-4d mean=%8.1fms p50=%8.1fms max=%8.1fms '
+          'per-check-rss=%7dKB resident-rss=%7dKB' %
+          (mode, len(walls), sum(walls) / len(walls),
+           walls[len(walls) // 2], walls[-1], rss, extra_rss))
+
+
+def main():
+    args = parse_args()
+    plugin = os.path.join(args.plugin_dir, args.plugin)
+    maasd = os.path.join(args.plugin_dir, 'maasd.py')
+
+    fork = [timed_run([sys.executable, plugin] + args.args)
+            for _ in range(args.runs)]
+
+    socket_path = os.path.join(tempfile.mkdtemp(), 'maasd.sock')
+    env = dict(os.environ, MAASD_SOCKET=socket_path)
+    daemon = subprocess.Popen([sys.executable, maasd, '--serve', socket_path])
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.1)
+        else:
+            sys.exit('maasd did not create %s' % socket_path)
+        shim = [sys.executable, maasd, args.plugin] + args.args
+        # The first run through the daemon pays the import cost once.
+        cold = timed_run(shim, env)
+        warm = [timed_run(shim, env) for _ in range(args.runs)]
+        daemon_rss = peak_rss(daemon.pid)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    summarise('fork', fork)
+    summarise('cold', [cold], daemon_rss)
+    summarise('maasd', warm, daemon_rss)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# Copyright 2015, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how long each plugin takes to import and how much memory it uses.
+
+Each plugin is loaded in a fresh interpreter without running its main block,
+so the numbers reflect only module level imports. The cost of starting a bare
+interpreter is subtracted from the reported times.
+
+    ./bench_plugin_imports.py --save imports.json
+    ./bench_plugin_imports.py --compare imports.json --tolerance 25
+"""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'plugins')
+LOADER = ('import imp, sys; sys.path.insert(0, sys.argv[1]); '
+          'imp.load_source("maas_plugin", sys.argv[2])')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Imports per plugin; the median is reported.')
+    parser.add_argument('--plugin-dir', default=PLUGIN_DIR)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='Fail if any plugin takes longer to import.')
+    parser.add_argument('--save', help='Write the results to this file.')
+    parser.add_argument('--compare',
+                        help='Fail if a plugin got slower than in the results '
+                             'previously saved to this file.')
+    parser.add_argument('--tolerance', type=float, default=20.0,
+                        help='Percentage slowdown allowed by --compare.')
+    parser.add_argument('plugins', nargs='*',
+                        help='Plugin file names; defaults to all of them.')
+    return parser.parse_args()
+
+
+def timed_run(command):
+    """Run ``command``; return (wall ms, peak RSS KB, return code)."""
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        proc = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        elapsed = (time.time() - start) * 1000
+    return elapsed, rusage.ru_maxrss, os.WEXITSTATUS(status)
+
+
+def median_run(command, runs):
+    samples = sorted(timed_run(command) for _ in range(runs))
+    return samples[len(samples) // 2]
+
+
+def main():
+    args = parse_args()
+    plugins = args.plugins or sorted(
+        os.path.basename(p)
+        for p in glob.glob(os.path.join(args.plugin_dir, '*.py')))
+
+    base_ms, base_rss, _ = median_run([sys.executable, '-c', 'pass'],
+                                      args.runs)
+    print('interpreter baseline: %.1fms %dKB' % (base_ms, base_rss))
+
+    results = {}
+    for plugin in plugins:
+        path = os.path.join(args.plugin_dir, plugin)
+        elapsed, rss, returncode = median_run(
+            [sys.executable, '-c', LOADER, args.plugin_dir, path], args.runs)
+        results[plugin] = {'ms': max(elapsed - base_ms, 0.0),
+                           'rss_kb': rss,
+                           'ok': returncode == 0}
+        print('%-36s %8.1fms %8dKB%s' % (
+            plugin, results[plugin]['ms'], rss,
+            '' if returncode == 0 else '  (import failed)'))
+
+    failures = []
+    if args.max_ms is not None:
+        failures.extend('%s imports in %.1fms, over the %.1fms budget' %
+                        (p, r['ms'], args.max_ms)
+                        for p, r in sorted(results.items())
+                        if r['ms'] > args.max_ms)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        for plugin, result in sorted(results.items()):
+            if plugin not in previous:
+                continue
+            limit = previous[plugin]['ms'] * (1 + args.tolerance / 100.0)
+            if result['ms'] > limit:
+                failures.append('%s imports in %.1fms, was %.1fms' %
+                                (plugin, result['ms'],
+                                 previous[plugin]['ms']))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
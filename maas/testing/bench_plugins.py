@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# Copyright 2015, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how long the plugins take to check a cloud of a given size.
+
+The OpenStack, RabbitMQ and Elasticsearch APIs and memcached are served by
+fake_cloud.py and the ceph, iostat, mysql and swift-recon commands are
+replaced by the scripts in fake-bin, so no real service is needed. Each
+scenario runs the plugin in a fresh interpreter, exactly as the agent
+would, and reports the median wall time, the median CPU time, the peak RSS
+and the number of metrics printed.
+
+    ./bench_plugins.py --size large --save large.json
+    ./bench_plugins.py --size large --compare large.json --tolerance 25
+    ./bench_plugins.py --size medium rabbitmq_status galera_check
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_cloud
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.join(TESTING_DIR, os.pardir, 'plugins')
+FAKE_BIN = os.path.join(TESTING_DIR, 'fake-bin')
+HOST = '127.0.0.1'
+
+# {size: ({fake_cloud option: value}, {fake-bin environment: value})}
+SIZES = {
+    'small': ({'computes': 10, 'servers': 100, 'agents': 30,
+               'networks': 20, 'volumes': 100, 'snapshots': 20,
+               'backends': 3, 'images': 50, 'users': 50,
+               'connections': 200, 'queues': 300, 'slabs': 10,
+               'logs': 5000},
+              {'FAKE_CEPH_OSDS': 12, 'FAKE_CEPH_PGS': 1024,
+               'FAKE_IOSTAT_DEVICES': 4, 'FAKE_GALERA_NODES': 3,
+               'FAKE_SWIFT_HOSTS': 3}),
+    'medium': ({'computes': 200, 'servers': 5000, 'agents': 300,
+                'networks': 500, 'volumes': 2000, 'snapshots': 500,
+                'backends': 20, 'images': 1000, 'users': 1000,
+                'connections': 2000, 'queues': 3000, 'slabs': 30,
+                'logs': 20000},
+               {'FAKE_CEPH_OSDS': 120, 'FAKE_CEPH_PGS': 16384,
+                'FAKE_IOSTAT_DEVICES': 24, 'FAKE_GALERA_NODES': 3,
+                'FAKE_SWIFT_HOSTS': 30}),
+    'large': ({'computes': 1000, 'servers': 30000, 'agents': 1500,
+               'networks': 3000, 'volumes': 10000, 'snapshots': 3000,
+               'backends': 100, 'images': 5000, 'users': 10000,
+               'connections': 10000, 'queues': 20000, 'slabs': 42,
+               'logs': 100000},
+              {'FAKE_CEPH_OSDS': 1000, 'FAKE_CEPH_PGS': 131072,
+               'FAKE_IOSTAT_DEVICES': 60, 'FAKE_GALERA_NODES': 5,
+               'FAKE_SWIFT_HOSTS': 200}),
+}
+
+# (name, plugin, arguments); {tmp} is replaced by the scratch directory
+SCENARIOS = [
+    ('nova_api_local_check', 'nova_api_local_check.py', [HOST]),
+    ('nova_service_check', 'nova_service_check.py',
+     [HOST, '--host', 'compute1']),
+    ('nova_service_check_aggregate', 'nova_service_check.py',
+     [HOST, '--aggregate', '--state-file', '{tmp}/nova_states.json']),
+    ('neutron_api_local_check', 'neutron_api_local_check.py', [HOST]),
+    ('neutron_service_check', 'neutron_service_check.py',
+     [HOST, '--host', 'network1']),
+    ('neutron_service_check_aggregate', 'neutron_service_check.py',
+     [HOST, '--aggregate', '--state-file', '{tmp}/neutron_states.json']),
+    ('cinder_api_local_check', 'cinder_api_local_check.py', [HOST]),
+    ('cinder_service_check', 'cinder_service_check.py',
+     [HOST, '--host', 'cinder1', '--snapshot-file', '{tmp}/cinder.json']),
+    ('glance_api_local_check', 'glance_api_local_check.py', [HOST]),
+    ('glance_registry_local_check', 'glance_registry_local_check.py',
+     [HOST]),
+    ('heat_api_local_check', 'heat_api_local_check.py', [HOST]),
+    ('keystone_api_local_check', 'keystone_api_local_check.py', [HOST]),
+    ('api_sweep', 'api_sweep.py',
+     ['%s=%s' % (service, HOST)
+      for service in ('nova', 'cinder', 'glance', 'heat', 'keystone',
+                      'neutron')]),
+    ('rabbitmq_status', 'rabbitmq_status.py',
+     ['-H', HOST, '-n', 'rabbit1']),
+    ('rabbitmq_queues', 'rabbitmq_status.py', ['-H', HOST, '--queues']),
+    ('memcached_status', 'memcached_status.py', [HOST]),
+    ('memcached_nodes', 'memcached_status.py',
+     ['--nodes', '%s,localhost' % HOST]),
+    ('elasticsearch', 'elasticsearch.py', ['-H', HOST]),
+    ('elasticsearch_window', 'elasticsearch.py',
+     ['-H', HOST, '--window', '15']),
+    ('galera_check', 'galera_check.py', ['--cli']),
+    ('galera_cluster', 'galera_check.py',
+     ['--cli', '--cluster', '--nodes', '10.0.0.1,10.0.0.2,10.0.0.3']),
+    ('swift_recon_replication', 'swift-recon.py',
+     ['replication', '--ring-type', 'object']),
+    ('swift_recon_async_pendings', 'swift-recon.py', ['async-pendings']),
+    ('swift_recon_md5', 'swift-recon.py', ['md5']),
+    ('swift_recon_quarantine', 'swift-recon.py', ['quarantine']),
+    ('ceph_cluster', 'ceph_monitoring.py',
+     ['--name', 'client.admin', '--keyring', os.devnull, 'cluster']),
+    ('ceph_osd', 'ceph_monitoring.py',
+     ['--name', 'client.admin', '--keyring', os.devnull, 'osd',
+      '--osd_ids', '0 1 2 3']),
+    ('disk_utilisation', 'disk_utilisation.py', []),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', choices=sorted(SIZES), default='small',
+                        help='Size of the fake cloud.')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Runs per scenario; the median is reported.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Milliseconds the fake APIs wait before each '
+                             'response.')
+    parser.add_argument('--overflow', default='error',
+                        choices=['error', 'split', 'summary'],
+                        help='MAAS_METRIC_OVERFLOW for the plugins; the '
+                             'default is the agent\'s.')
+    parser.add_argument('--plugin-dir', default=PLUGIN_DIR)
+    parser.add_argument('--save', help='Write the results to this file.')
+    parser.add_argument('--compare',
+                        help='Fail if a scenario got slower than in the '
+                             'results previously saved to this file.')
+    parser.add_argument('--tolerance', type=float, default=20.0,
+                        help='Percentage slowdown allowed by --compare.')
+    parser.add_argument('scenarios', nargs='*',
+                        help='Scenario names; defaults to all of them.')
+    return parser.parse_args()
+
+
+def start_cloud(size, latency):
+    """Start fake_cloud.py and wait until it serves."""
+    command = [sys.executable, os.path.join(TESTING_DIR, 'fake_cloud.py'),
+               '--listen', HOST, '--latency', str(latency)]
+    for option, value in sorted(SIZES[size][0].items()):
+        command.extend(['--%s' % option, str(value)])
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    # the data is generated before the first line is printed
+    if not proc.stdout.readline():
+        sys.exit('fake_cloud.py failed to start')
+    return proc
+
+
+def make_environment(args, tmp):
+    """Point the plugins at the fakes with a token they can use as is."""
+    auth_ref = fake_cloud.token(HOST)
+    auth_ref.update({'auth_token': fake_cloud.TOKEN, 'version': 'v3'})
+    token_file = os.path.join(tmp, 'auth_ref.json')
+    with open(token_file, 'w') as f:
+        json.dump(auth_ref, f)
+
+    openrc = os.path.join(tmp, 'openrc')
+    with open(openrc, 'w') as f:
+        f.write('export OS_USERNAME=maas\n'
+                'export OS_PASSWORD=maas\n'
+                'export OS_TENANT_NAME=maas\n'
+                'export OS_AUTH_URL=http://%s:%d/v3\n' %
+                (HOST, fake_cloud.PORTS['keystone']))
+
+    env = dict(os.environ)
+    env.update((key, str(value))
+               for key, value in SIZES[args.size][1].items())
+    env.update({'MAAS_TOKEN_FILE': token_file,
+                'MAAS_OPENRC': openrc,
+                'MAAS_MYSQL': os.path.join(FAKE_BIN, 'mysql'),
+                'MAAS_METRIC_OVERFLOW': args.overflow,
+                'MAAS_SPOOL_DIR': os.path.join(tmp, 'spool'),
+                'MAAS_HISTORY_DIR': os.path.join(tmp, 'history'),
+                'PATH': os.pathsep.join([FAKE_BIN, env.get('PATH', '')])})
+    return env
+
+
+def timed_run(command, env):
+    """Run ``command``; return (wall ms, CPU ms, peak RSS KB, output)."""
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=devnull, env=env)
+        output = proc.stdout.read()
+        _, _, rusage = os.wait4(proc.pid, 0)
+        elapsed = (time.time() - start) * 1000
+    cpu = (rusage.ru_utime + rusage.ru_stime) * 1000
+    return elapsed, cpu, rusage.ru_maxrss, output
+
+
+def summarise(output):
+    """Return (status line, number of metrics) of a plugin's output."""
+    lines = output.splitlines()
+    status = next((line for line in lines if line.startswith('status ')),
+                  'no status printed')
+    return status, sum(1 for line in lines if line.startswith('metric '))
+
+
+def run_scenario(plugin, arguments, env, runs):
+    samples = [timed_run([sys.executable, plugin] + arguments, env)
+               for _ in range(runs)]
+    status, metrics = summarise(samples[-1][3])
+    return {'ms': sorted(s[0] for s in samples)[runs // 2],
+            'cpu_ms': sorted(s[1] for s in samples)[runs // 2],
+            'rss_kb': max(s[2] for s in samples),
+            'metrics': metrics,
+            'ok': status.startswith('status okay'),
+            'status': status}
+
+
+def main():
+    args = parse_args()
+    scenarios = [s for s in SCENARIOS
+                 if not args.scenarios or s[0] in args.scenarios]
+    unknown = set(args.scenarios) - set(s[0] for s in SCENARIOS)
+    if unknown:
+        sys.exit('Unknown scenarios: %s' % ', '.join(sorted(unknown)))
+
+    tmp = tempfile.mkdtemp(prefix='bench_plugins.')
+    cloud = start_cloud(args.size, args.latency)
+    try:
+        env = make_environment(args, tmp)
+        results = {}
+        for name, plugin, arguments in scenarios:
+            arguments = [a.format(tmp=tmp) for a in arguments]
+            result = run_scenario(os.path.join(args.plugin_dir, plugin),
+                                  arguments, env, args.runs)
+            results[name] = result
+            print('%-32s %8.1fms %8.1fms cpu %8dKB %3d metrics%s' % (
+                name, result['ms'], result['cpu_ms'], result['rss_kb'],
+                result['metrics'],
+                '' if result['ok'] else '  (%s)' % result['status'][:60]))
+    finally:
+        cloud.terminate()
+        cloud.wait()
+        shutil.rmtree(tmp)
+
+    failures = []
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        for name, result in sorted(results.items()):
+            if name not in previous:
+                continue
+            limit = previous[name]['ms'] * (1 + args.tolerance / 100.0)
+            if result['ms'] > limit:
+                failures.append('%s took %.1fms, was %.1fms' %
+                                (name, result['ms'], previous[name]['ms']))
+            if previous[name]['ok'] and not result['ok']:
+                failures.append('%s failed: %s' % (name, result['status']))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,671 @@
+#!/usr/bin/env python
+# Copyright 2015, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serve fake OpenStack and RabbitMQ management APIs of a configurable size.
+
+Every API listens on its usual port, as the plugins expect, and answers the
+requests the plugins make with data generated for a cloud of the requested
+size. Any token is accepted. A memcached answering the stats commands
+and an Elasticsearch holding logstash indices listen on their usual ports
+too.
+
+    ./fake_cloud.py --computes 500 --servers 10000 --volumes 5000
+"""
+
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import fnmatch
+import json
+import re
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+TENANT_ID = 'f4k3t3n4nt'
+TOKEN = 'fake-token'
+# {service: port}
+PORTS = {'keystone': 5000,
+         'keystone_admin': 35357,
+         'nova': 8774,
+         'neutron': 9696,
+         'cinder': 8776,
+         'glance': 9292,
+         'glance_registry': 9191,
+         'heat': 8004,
+         'rabbitmq': 15672,
+         'elasticsearch': 9200}
+MEMCACHED_PORT = 11211
+CONTROLLERS = ['controller%d' % i for i in range(1, 4)]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--listen', default='127.0.0.1')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Milliseconds added to every response.')
+    parser.add_argument('--computes', type=int, default=10)
+    parser.add_argument('--servers', type=int, default=100)
+    parser.add_argument('--agents', type=int, default=30,
+                        help='Neutron agents, at least 12.')
+    parser.add_argument('--networks', type=int, default=20)
+    parser.add_argument('--volumes', type=int, default=100)
+    parser.add_argument('--snapshots', type=int, default=20)
+    parser.add_argument('--backends', type=int, default=3,
+                        help='cinder-volume services.')
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--connections', type=int, default=200,
+                        help='RabbitMQ connections.')
+    parser.add_argument('--queues', type=int, default=300,
+                        help='RabbitMQ queues.')
+    parser.add_argument('--slabs', type=int, default=20,
+                        help='memcached slab classes.')
+    parser.add_argument('--logs', type=int, default=10000,
+                        help='Log entries in the latest logstash index.')
+    return parser.parse_args(argv)
+
+
+def uuid(kind, i):
+    return '%08x-0000-4000-8000-%012x' % (hash(kind) & 0xffffffff, i)
+
+
+def iso(offset=0):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000000Z',
+                         time.gmtime(time.time() + offset))
+
+
+def catalog(host):
+    return [{'type': service_type, 'name': name, 'endpoints': [
+        {'interface': interface, 'region': 'RegionOne',
+         'url': 'http://%s:%d%s' % (host, PORTS[name], suffix)}
+        for interface in ('public', 'internal', 'admin')]}
+        for service_type, name, suffix in (
+            ('identity', 'keystone', '/v3'),
+            ('compute', 'nova', '/v2/%s' % TENANT_ID),
+            ('network', 'neutron', ''),
+            ('volume', 'cinder', '/v1/%s' % TENANT_ID),
+            ('volumev2', 'cinder', '/v2/%s' % TENANT_ID),
+            ('image', 'glance', ''),
+            ('orchestration', 'heat', '/v1/%s' % TENANT_ID))]
+
+
+def token(host):
+    """Return the keystone v3 token body for a client of ``host``."""
+    return {'methods': ['password'], 'expires_at': iso(86400),
+            'issued_at': iso(), 'audit_ids': ['fake'],
+            'project': {'id': TENANT_ID, 'name': 'maas',
+                        'domain': {'id': 'default', 'name': 'Default'}},
+            'user': {'id': uuid('user', 0), 'name': 'maas',
+                     'domain': {'id': 'default', 'name': 'Default'}},
+            'roles': [{'id': uuid('role', 0), 'name': 'admin'}],
+            'catalog': catalog(host)}
+
+
+class Cloud(object):
+    """The data behind the fake APIs."""
+
+    def __init__(self, args):
+        self.started = time.time()
+        self.nova_services = [
+            {'id': i, 'binary': binary, 'host': host, 'zone': 'internal',
+             'status': 'enabled', 'state': 'up', 'updated_at': iso(),
+             'disabled_reason': None}
+            for i, (binary, host) in enumerate(
+                [(b, h) for h in CONTROLLERS
+                 for b in ('nova-scheduler', 'nova-conductor',
+                           'nova-consoleauth', 'nova-cert')] +
+                [('nova-compute', 'compute%d' % i)
+                 for i in range(args.computes)])]
+        # one compute in 50 is down
+        for service in self.nova_services[len(CONTROLLERS) * 4::50]:
+            service['state'] = 'down'
+
+        self.servers = [
+            {'id': uuid('server', i), 'name': 'server-%d' % i,
+             'status': ('ACTIVE', 'ACTIVE', 'ACTIVE', 'STOPPED', 'ERROR')[
+                 i % 5],
+             'tenant_id': TENANT_ID, 'user_id': uuid('user', i % 10),
+             'hostId': uuid('host', i % max(args.computes, 1)),
+             'OS-EXT-SRV-ATTR:host': 'compute%d' % (
+                 i % max(args.computes, 1)),
+             'flavor': {'id': '2'}, 'image': {'id': uuid('image', 0)},
+             'addresses': {'private': [{'addr': '10.0.%d.%d' % (
+                 i // 250 % 250, i % 250 + 2), 'version': 4}]},
+             'metadata': {}, 'created': iso(-86400), 'updated': iso()}
+            for i in range(args.servers)]
+
+        agents = [(b, h) for h in ['network%d' % i for i in range(1, 4)]
+                  for b in ('neutron-dhcp-agent', 'neutron-l3-agent',
+                            'neutron-metadata-agent',
+                            'neutron-linuxbridge-agent')]
+        agents += [('neutron-linuxbridge-agent', 'compute%d' % i)
+                   for i in range(max(args.agents - len(agents), 0))]
+        self.agents = [
+            {'id': uuid('agent', i), 'binary': binary, 'host': host,
+             'agent_type': binary, 'admin_state_up': True,
+             'alive': i % 40 != 39, 'topic': 'N/A',
+             'heartbeat_timestamp': iso(), 'configurations': {}}
+            for i, (binary, host) in enumerate(agents)]
+        self.networks = [
+            {'id': uuid('network', i), 'name': 'net-%d' % i,
+             'tenant_id': TENANT_ID, 'status': 'ACTIVE',
+             'subnets': [uuid('subnet', i)], 'admin_state_up': True}
+            for i in range(args.networks)]
+        self.subnets = [
+            {'id': uuid('subnet', i), 'network_id': uuid('network', i),
+             'cidr': '10.%d.%d.0/24' % (i // 250 % 250, i % 250),
+             'enable_dhcp': True, 'tenant_id': TENANT_ID}
+            for i in range(args.networks)]
+        self.routers = [
+            {'id': uuid('router', i), 'name': 'router-%d' % i,
+             'tenant_id': TENANT_ID, 'status': 'ACTIVE'}
+            for i in range(max(args.networks // 4, 1))]
+        self.ports = [
+            {'id': uuid('port', i), 'network_id': uuid('network', i),
+             'device_owner': 'network:dhcp', 'status': 'ACTIVE'}
+            for i in range(args.networks)]
+
+        self.cinder_services = [
+            {'binary': 'cinder-scheduler', 'host': host, 'zone': 'nova',
+             'status': 'enabled', 'state': 'up', 'updated_at': iso()}
+            for host in CONTROLLERS]
+        self.cinder_services += [
+            {'binary': 'cinder-volume',
+             'host': 'cinder%d@lvm' % i, 'zone': 'nova',
+             'status': 'enabled', 'state': 'down' if i % 25 == 24 else 'up',
+             'updated_at': iso()}
+            for i in range(args.backends)]
+        statuses = ('available', 'in-use', 'in-use', 'error')
+        self.volumes = [
+            {'id': uuid('volume', i), 'display_name': 'volume-%d' % i,
+             'status': statuses[i % 4], 'size': 10 + i % 100,
+             'volume_type': None, 'bootable': 'false',
+             'availability_zone': 'nova', 'created_at': iso(-3600),
+             'attachments': [], 'metadata': {},
+             'os-vol-host-attr:host': 'cinder%d@lvm' % (
+                 i % max(args.backends, 1))}
+            for i in range(args.volumes)]
+        self.snapshots = [
+            {'id': uuid('snapshot', i), 'volume_id': uuid('volume', i),
+             'status': statuses[i % 4], 'size': 10,
+             'created_at': iso(-3600)}
+            for i in range(args.snapshots)]
+
+        self.images = [
+            {'id': uuid('image', i), 'name': 'image-%d' % i,
+             'status': ('active', 'active', 'queued', 'killed')[i % 4],
+             'size': 1 << 30, 'disk_format': 'qcow2',
+             'container_format': 'bare', 'is_public': True,
+             'checksum': '%032x' % i, 'properties': {},
+             'created_at': iso(-86400), 'updated_at': iso()}
+            for i in range(args.images)]
+
+        self.users = [{'id': uuid('user', i), 'name': 'user%d' % i,
+                       'domain_id': 'default', 'enabled': True}
+                      for i in range(args.users)]
+        self.projects = [{'id': uuid('project', i), 'name': 'project%d' % i,
+                          'domain_id': 'default', 'enabled': True}
+                         for i in range(max(args.users // 5, 1))]
+        self.keystone_services = [
+            {'id': uuid('service', i), 'type': service, 'name': service}
+            for i, service in enumerate(sorted(PORTS))]
+
+        self.rabbit_nodes = [
+            {'name': 'rabbit@rabbit%d' % i, 'running': True,
+             'proc_used': 2000 + i, 'proc_total': 1048576,
+             'fd_used': 300 + i, 'fd_total': 65536,
+             'sockets_used': 250 + i, 'sockets_total': 58890,
+             'mem_used': 200 << 20, 'mem_limit': 3 << 30,
+             'mem_alarm': False, 'disk_free_alarm': False,
+             'uptime': 86400000, 'run_queue': 1,
+             'applications': {'rabbit': {'version': '3.5.6'}}}
+            for i in range(1, 4)]
+        self.rabbit_connections = [
+            {'name': '10.0.0.%d:%d -> 10.0.0.1:5672' % (i % 250, 40000 + i),
+             'node': 'rabbit@rabbit%d' % (i % 3 + 1),
+             'channels': 1 + i % 7, 'state': 'running',
+             'user': 'openstack', 'vhost': '/', 'recv_oct': i * 1000,
+             'send_oct': i * 2000, 'client_properties': {
+                 'product': 'py-amqp', 'version': '1.4.6',
+                 'capabilities': {'publisher_confirms': True}}}
+            for i in range(args.connections)]
+        self.rabbit_queues = [
+            {'name': 'queue-%d' % i, 'vhost': '/' if i % 4 else '/heat',
+             'node': 'rabbit@rabbit%d' % (i % 3 + 1),
+             'messages': (i * 7919) % 500 if i % 10 == 0 else 0,
+             'messages_ready': (i * 7919) % 400 if i % 10 == 0 else 0,
+             'messages_unacknowledged': i % 3, 'consumers': i % 4,
+             'durable': False, 'auto_delete': False,
+             'message_stats': {'publish': i * 10, 'deliver_get': i * 10,
+                               'ack': i * 10}}
+            for i in range(args.queues)]
+        self.slabs = args.slabs
+        # the entries of the last day; 3% are errors and 7% warnings
+        services = ['nova', 'neutron', 'cinder', 'glance', 'heat',
+                    'keystone', 'swift', 'rabbitmq', 'horizon', 'ceph-osd']
+        # the tags of each service, those behind apache are tagged by it too
+        tags = dict((service, [service, 'openstack', 'oslofmt', 'beaver'])
+                    for service in services)
+        for service in ('keystone', 'horizon'):
+            tags[service].append('apache-access')
+        self.logs = [
+            {'@timestamp': self.started - i * 86400.0 / args.logs,
+             'tags': tags[services[i * 7 % len(services)]],
+             'message': '%s %s.api request %d' % (
+                 'ERROR' if i % 100 < 3 else
+                 'WARNING' if i % 100 < 10 else 'INFO',
+                 services[i * 7 % len(services)], i)}
+            for i in range(args.logs)]
+        self.rabbit_overview = {
+            'rabbitmq_version': '3.5.6',
+            'queue_totals': {
+                'messages': sum(q['messages'] for q in self.rabbit_queues),
+                'messages_ready': sum(q['messages_ready']
+                                      for q in self.rabbit_queues),
+                'messages_unacknowledged': sum(
+                    q['messages_unacknowledged']
+                    for q in self.rabbit_queues)},
+            'message_stats': {'get': 0, 'ack': 100000, 'deliver_get': 100000,
+                              'deliver': 100000, 'publish': 100000},
+            'object_totals': {'connections': len(self.rabbit_connections),
+                              'queues': len(self.rabbit_queues)}}
+
+    def queues_now(self):
+        """Return the queues with their message counters at this time."""
+        elapsed = int(time.time() - self.started)
+        return [dict(q, message_stats=dict(
+            (k, v + elapsed * (i % 5)) for k, v in q['message_stats'].items()))
+            for i, q in enumerate(self.rabbit_queues)]
+
+    def vhosts_now(self):
+        """Return the vhosts with the message counters of their queues."""
+        vhosts = {}
+        for queue in self.queues_now():
+            stats = vhosts.setdefault(queue['vhost'], {}).setdefault(
+                'message_stats', {})
+            for k, v in queue['message_stats'].items():
+                stats[k] = stats.get(k, 0) + v
+        return [dict(vhost, name=name) for name, vhost in vhosts.items()]
+
+    def log_indices(self):
+        """Return the daily logstash indices of the last week."""
+        return ['logstash-%s' % time.strftime(
+            '%Y.%m.%d', time.gmtime(self.started - day * 86400))
+            for day in range(7)]
+
+    def memcached_stats(self):
+        """Return the answers of memcached to the stats commands.
+
+        The counters grow with time; one slab class in four evicts.
+        """
+        elapsed = int(time.time() - self.started) + 1
+        slabs = range(1, self.slabs + 1)
+        stats = [('pid', 1234), ('uptime', 86400 + elapsed),
+                 ('version', '1.4.15'), ('curr_connections', 410),
+                 ('total_connections', 52000 + elapsed * 5),
+                 ('rejected_connections', elapsed // 10),
+                 ('cmd_get', 1000000 + elapsed * 1000),
+                 ('get_hits', 900000 + elapsed * 900),
+                 ('get_misses', 100000 + elapsed * 100),
+                 ('bytes', 60 << 20), ('curr_items', 120000),
+                 ('total_items', 800000 + elapsed * 50),
+                 ('evictions', sum(slab * elapsed for slab in slabs
+                                   if slab % 4 == 0)),
+                 ('limit_maxbytes', 64 << 20), ('threads', 4)]
+        settings = [('maxbytes', 64 << 20), ('maxconns', 1024),
+                    ('tcpport', MEMCACHED_PORT), ('evictions', 'on')]
+        slab_stats = []
+        item_stats = []
+        for slab in slabs:
+            slab_stats.extend([('%d:chunk_size' % slab, 96 * slab),
+                               ('%d:total_pages' % slab, 3),
+                               ('%d:total_chunks' % slab, 3000),
+                               ('%d:used_chunks' % slab,
+                                3000 if slab % 4 == 0 else 1200)])
+            item_stats.extend([('items:%d:number' % slab, 1000),
+                               ('items:%d:age' % slab, 3600),
+                               ('items:%d:evicted' % slab,
+                                slab * elapsed if slab % 4 == 0 else 0)])
+        slab_stats.extend([('active_slabs', self.slabs),
+                           ('total_malloced', 60 << 20)])
+        return {'stats': stats, 'stats settings': settings,
+                'stats slabs': slab_stats, 'stats items': item_stats}
+
+
+def filtered(items, query, fields):
+    for field in fields:
+        if field in query:
+            items = [i for i in items if str(i.get(field)) == query[field]]
+    return items
+
+
+def project(item, columns):
+    """Keep ``columns`` of ``item``; a.b selects b within a."""
+    result = {}
+    for column in columns:
+        value, target, keys = item, result, column.split('.')
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return result
+
+
+def rabbit_list(items, query):
+    """Answer like the management API, with paging and column selection."""
+    if 'sort' in query:
+        items = sorted(items, key=lambda i: i.get(query['sort']),
+                       reverse=query.get('sort_reverse') == 'true')
+    if 'columns' in query:
+        columns = query['columns'].split(',')
+        items = [project(i, columns) for i in items]
+    if 'page' not in query:
+        return items
+    page, page_size = int(query['page']), int(query.get('page_size', 100))
+    return {'items': items[(page - 1) * page_size:page * page_size],
+            'page': page, 'page_size': page_size,
+            'page_count': (len(items) + page_size - 1) // page_size,
+            'item_count': len(items[(page - 1) * page_size:
+                                    page * page_size]),
+            'filtered_count': len(items), 'total_count': len(items)}
+
+
+def es_matches(entry, query):
+    """Tell whether a log entry matches an Elasticsearch query or filter.
+
+    Only query_string queries on whole words, ranges with gte, and filtered
+    queries and query filters made of them are understood.
+    """
+    if 'query_string' in query:
+        pattern = query['query_string']['query']
+        words = ' '.join(str(entry.get(field, '')) for field in
+                         query['query_string'].get('fields', ['message']))
+        return any(fnmatch.fnmatchcase(word, pattern)
+                   for word in words.split())
+    if 'range' in query:
+        field, bounds = query['range'].items()[0]
+        # only now-<N>m is understood
+        return entry[field] >= time.time() - int(bounds['gte'][4:-1]) * 60
+    if 'filtered' in query:
+        return all(es_matches(entry, query['filtered'].get(part,
+                                                           {'match_all': {}}))
+                   for part in ('query', 'filter'))
+    if 'query' in query:
+        return es_matches(entry, query['query'])
+    return 'match_all' in query
+
+
+def es_terms(entry, field):
+    """Return the terms of ``field`` indexed for a log entry.
+
+    As with the mapping of the elasticsearch role, string fields are
+    analyzed into lower case words, and their .raw sub-field holds the whole
+    values.
+    """
+    if field.endswith('.raw'):
+        return entry.get(field[:-len('.raw')], [])
+    return [word for value in entry.get(field, [])
+            for word in re.findall(r'\w+', value.lower())]
+
+
+def es_aggregate(entries, aggs):
+    """Compute the aggregations ``aggs`` of the log entries.
+
+    Only filters, terms and date_histogram with an interval in minutes are
+    understood, along with their sub-aggregations.
+    """
+    result = {}
+    for name, agg in aggs.items():
+        groups = []
+        if 'filters' in agg:
+            groups = [(key, [e for e in entries if es_matches(e, f)])
+                      for key, f in agg['filters']['filters'].items()]
+        elif 'terms' in agg:
+            terms = agg['terms']
+            exclude = re.compile('(%s)$' % terms.get('exclude', '(?!)'))
+            values = {}
+            for entry in entries:
+                for value in es_terms(entry, terms['field']):
+                    if not exclude.match(value):
+                        values.setdefault(value, []).append(entry)
+            groups = sorted(values.items(), key=lambda v: -len(v[1]))
+            groups = groups[:terms.get('size', 10)]
+        elif 'date_histogram' in agg:
+            interval = int(agg['date_histogram']['interval'][:-1]) * 60
+            minutes = {}
+            for entry in entries:
+                key = int(entry['@timestamp'] // interval * interval * 1000)
+                minutes.setdefault(key, []).append(entry)
+            groups = sorted(minutes.items())
+        buckets = [dict(es_aggregate(group, agg.get('aggs', {})),
+                        key=key, doc_count=len(group))
+                   for key, group in groups]
+        if 'filters' in agg:
+            buckets = dict((bucket.pop('key'), bucket) for bucket in buckets)
+        result[name] = {'buckets': buckets}
+    return result
+
+
+def es_search(entries, body):
+    """Answer a search of the log entries, without returning any hit."""
+    query = body.get('query', {'match_all': {}})
+    entries = [e for e in entries if es_matches(e, query)]
+    return {'took': 1, 'timed_out': False,
+            'hits': {'total': len(entries), 'hits': []},
+            'aggregations': es_aggregate(entries, body.get('aggs', {}))}
+
+
+def make_handler(cloud, latency):
+    # responses which do not depend on the query string are encoded once
+    cache = {}
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def service(self):
+            port = self.server.server_address[1]
+            return [s for s, p in PORTS.items() if p == port][0]
+
+        def reply(self, code, body, headers=None):
+            if not isinstance(body, str):
+                body = json.dumps(body)
+            if latency:
+                time.sleep(latency / 1000.0)
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for header in (headers or {}).items():
+                self.send_header(*header)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            self.rfile.read(length)
+            host = self.headers.get('Host', '127.0.0.1').split(':')[0]
+            path = urlparse.urlparse(self.path).path.rstrip('/')
+            if path.endswith('/v3/auth/tokens'):
+                self.reply(201, {'token': token(host)},
+                           {'X-Subject-Token': TOKEN})
+            elif path.endswith('/v2.0/tokens'):
+                body = token(host)
+                self.reply(200, {'access': {
+                    'token': {'id': TOKEN, 'expires': body['expires_at'],
+                              'tenant': {'id': TENANT_ID, 'name': 'maas'}},
+                    'user': {'id': body['user']['id'], 'name': 'maas',
+                             'roles': [{'name': 'admin'}]},
+                    'serviceCatalog': [
+                        {'type': s['type'], 'name': s['name'],
+                         'endpoints': [dict(
+                             ('%sURL' % e['interface'], e['url'])
+                             for e in s['endpoints'])]}
+                        for s in body['catalog']]}})
+            else:
+                self.reply(404, {'error': 'not found'})
+
+        def do_GET(self):
+            url = urlparse.urlparse(self.path)
+            path = url.path.rstrip('/')
+            if path.endswith('.json'):
+                path = path[:-len('.json')]
+            query = dict(urlparse.parse_qsl(url.query))
+            if self.service() == 'elasticsearch':
+                self.elasticsearch(path)
+                return
+            key = (self.service(), path)
+            if not query and key in cache:
+                self.reply(200, cache[key])
+                return
+            body = self.route(self.service(), path, query)
+            if body is None:
+                self.reply(404, {'error': 'not found'})
+                return
+            body = json.dumps(body)
+            if not query:
+                cache[key] = body
+            self.reply(200, body)
+
+        def elasticsearch(self, path):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or '{}')
+            if path.startswith('/_cat/indices'):
+                pattern = path.split('/')[3] if path.count('/') > 2 else '*'
+                self.reply(200, ''.join(
+                    '%s\n' % index for index in cloud.log_indices()
+                    if fnmatch.fnmatchcase(index, pattern)))
+            elif path.endswith('/_search'):
+                self.reply(200, es_search(cloud.logs, body))
+            else:
+                self.reply(404, {'error': 'not found'})
+
+        def route(self, service, path, query):
+            parts = path.strip('/').split('/')
+            resource = parts[-1]
+            if service in ('keystone', 'keystone_admin'):
+                return {'services': {'services': cloud.keystone_services},
+                        'projects': {'projects': cloud.projects},
+                        'tenants': {'tenants': cloud.projects},
+                        'users': {'users': cloud.users}}.get(resource)
+            if service == 'nova':
+                if resource == 'os-services':
+                    return {'services': filtered(cloud.nova_services, query,
+                                                 ('host', 'binary'))}
+                if path.endswith('/servers/detail'):
+                    return {'servers': cloud.servers}
+            if service == 'neutron':
+                items = {'agents': cloud.agents,
+                         'networks': cloud.networks,
+                         'subnets': cloud.subnets,
+                         'routers': cloud.routers,
+                         'ports': cloud.ports}.get(resource)
+                if items is not None:
+                    return {resource: filtered(items, query,
+                                               ('host', 'binary',
+                                                'device_owner'))}
+            if service == 'cinder':
+                if resource == 'os-services':
+                    return {'services': filtered(cloud.cinder_services,
+                                                 query, ('host', 'binary'))}
+                if path.endswith('/volumes/detail'):
+                    return {'volumes': cloud.volumes}
+                if path.endswith('/snapshots/detail'):
+                    return {'snapshots': cloud.snapshots}
+            if service == 'glance':
+                if path.endswith('/images/detail'):
+                    return {'images': cloud.images}
+                if path in ('', '/v1', '/v2'):
+                    return {'versions': [{'id': 'v1.1',
+                                          'status': 'CURRENT'}]}
+            if service == 'glance_registry' and resource == 'images':
+                return {'images': [dict((k, i[k]) for k in (
+                    'id', 'name', 'status', 'size', 'disk_format',
+                    'container_format', 'checksum'))
+                    for i in cloud.images]}
+            if service == 'heat' and resource == 'build_info':
+                return {'api': {'revision': '2015.1'},
+                        'engine': {'revision': '2015.1'}}
+            if service == 'rabbitmq':
+                if path == '/api/overview':
+                    return cloud.rabbit_overview
+                if path == '/api/nodes':
+                    return cloud.rabbit_nodes
+                if path == '/api/connections':
+                    return rabbit_list(cloud.rabbit_connections, query)
+                if path == '/api/queues':
+                    return rabbit_list(cloud.queues_now(), query)
+                if path == '/api/vhosts':
+                    return rabbit_list(cloud.vhosts_now(), query)
+            return None
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_memcached_handler(cloud):
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            for line in iter(self.rfile.readline, ''):
+                answers = cloud.memcached_stats()
+                command = line.strip()
+                if command not in answers:
+                    self.wfile.write('ERROR\r\n')
+                    continue
+                self.wfile.write(''.join('STAT %s %s\r\n' % stat
+                                         for stat in answers[command]) +
+                                 'END\r\n')
+                self.wfile.flush()
+
+    return Handler
+
+
+class MemcachedServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    args = parse_args()
+    cloud = Cloud(args)
+    handler = make_handler(cloud, args.latency)
+    servers = [Server((args.listen, port), handler)
+               for port in sorted(PORTS.values())]
+    servers.append(MemcachedServer((args.listen, MEMCACHED_PORT),
+                                   make_memcached_handler(cloud)))
+    for server in servers[1:]:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    print('fake cloud listening on %s' % args.listen)
+    sys.stdout.flush()
+    servers[0].serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Copyright 2015, Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Check that api_sweep.py fits the agent's limits against fake_cloud.py.
+
+    ./test_api_sweep.py
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import bench_plugins
+
+sys.path.insert(0, bench_plugins.PLUGIN_DIR)
+import api_sweep  # noqa
+import maas_common  # noqa
+
+SERVICES = ['%s=%s' % (service, bench_plugins.HOST)
+            for service in sorted(api_sweep.SERVICES)]
+
+
+class FailingSession(object):
+    def get(self, url, **kwargs):
+        raise ValueError('No JSON object could be decoded')
+
+
+class APISweepTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix='test_api_sweep.')
+        cls.cloud = bench_plugins.start_cloud('small', 0)
+        # the agent fails a check printing more than MAX_METRICS metrics
+        cls.env = bench_plugins.make_environment(
+            argparse.Namespace(size='small', overflow='error'), cls.tmp)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.cloud.terminate()
+        cls.cloud.wait()
+        shutil.rmtree(cls.tmp)
+
+    def sweep(self, *args):
+        plugin = os.path.join(bench_plugins.PLUGIN_DIR, 'api_sweep.py')
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.Popen(
+                [sys.executable, plugin] + list(args), env=self.env,
+                stdout=subprocess.PIPE, stderr=devnull).communicate()[0]
+        return output.splitlines()
+
+    def test_default_sweep_fits_metric_limit(self):
+        lines = self.sweep(*SERVICES)
+        self.assertEqual('status okay', lines[0])
+        metrics = [line for line in lines if line.startswith('metric ')]
+        self.assertEqual(2 * len(SERVICES), len(metrics))
+        self.assertTrue(len(metrics) <= maas_common.MAX_METRICS)
+        for service in sorted(api_sweep.SERVICES):
+            self.assertIn('metric %s_api_local_status uint32 1' % service,
+                          lines)
+
+    def test_details_add_resource_counts(self):
+        lines = self.sweep('nova=%s' % bench_plugins.HOST, '--details')
+        self.assertEqual('status okay', lines[0])
+        self.assertIn('metric nova_instances_in_state_ERROR', '\n'.join(lines))
+
+    def test_unexpected_failure_reports_only_that_api_down(self):
+        service = ('nova', bench_plugins.HOST, 8774, '')
+        is_up, metrics, error = api_sweep.sweep(service, FailingSession(),
+                                                'tenant')
+        self.assertFalse(is_up)
+        self.assertEqual([], metrics)
+        self.assertIn('nova: No JSON object could be decoded', error)
+
+
+if __name__ == '__main__':
+    unittest.main()